@@ -1,22 +1,90 @@
+import hashlib
+import itertools
+import copy
+import functools
+import io
+import json
+import locale
 import logging
+import mmap
 import os
 import re
+import shlex
 import subprocess
-from pathlib import Path
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
 
-# import functools
 from collections import Counter, defaultdict, namedtuple
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pprint import pformat
 
 from .utils.txt_op import remove_comment, convert_op_c2py, get_token_param_str, iter_arguments
+from .utils.txt_op import iter_directive_lines
+from .utils.stats import BuildStats, deep_sizeof
+
+
+class Define:
+    """compact record of one #define, the raw `line` is rebuilt on demand instead of stored
+
+    `file` is the ID of the defining file in `Parser.files`, 0 if not from a file.
+    """
+
+    __slots__ = ("name", "params", "token", "file", "lineno")
+
+    def __init__(self, name, params=None, token="", line=None, file="", lineno=0):
+        self.name = sys.intern(name)
+        self.params = tuple(params) if params is not None else None
+        self.token = token
+        self.file = file
+        self.lineno = lineno
+
+    @property
+    def line(self) -> str:
+        if self.params is None:
+            return "#define %s %s" % (self.name, self.token)
+        return "#define %s(%s) %s" % (self.name, ", ".join(self.params), self.token)
+
+    def __reduce__(self):
+        return (Define, (self.name, self.params, self.token, None, self.file, self.lineno))
+
+    def __eq__(self, other):
+        if not isinstance(other, Define):
+            return NotImplemented
+        return self.__reduce__()[1] == other.__reduce__()[1]
+
+    def __hash__(self):
+        return hash((self.name, self.params, self.token, self.file, self.lineno))
+
+    def __repr__(self):
+        return "Define(name={!r}, params={!r}, token={!r}, file={!r}, lineno={!r})".format(
+            self.name, self.params, self.token, self.file, self.lineno
+        )
 
 
-Define = namedtuple(
-    "Define",
-    ("name", "params", "token", "line", "file", "lineno"),
-)
 Token = namedtuple("Token", ("name", "params", "line", "span"))
+ExpandLimits = namedtuple("ExpandLimits", ("depth", "steps", "timeout"))
+
+
+class TruncatedToken(str):
+    """partially expanded token, the expansion stopped at a limit of ExpandLimits"""
+
+    truncated = True
+
+
+EvalResult = namedtuple("EvalResult", ("expanded", "value"))
+
+
+REGEX_INT_STR = re.compile(r"-?(?:0|[1-9][0-9]*)")  # as `str(int)` gives
+
+
+def _is_number(token: str) -> bool:
+    return REGEX_INT_STR.fullmatch(token) is not None
+
 
 WORD_BOUNDARY = lambda word: r"\b(\s*##\s*)?%s\b" % re.escape(word)
 
@@ -27,19 +95,46 @@ REGEX_DEFINE = re.compile(
     + r"(?P<HAS_PAREN>\((?P<PARAMS>[\w\., ]*)\))*\s*(?P<TOKEN>.+)*"
 )
 REGEX_UNDEF = re.compile(r"#\s*undef\s+" + REGEX_TOKEN.pattern)
-REGEX_INCLUDE = re.compile(r'#\s*include\s+["<](?P<PATH>.+)[">]\s*')
+REGEX_INCLUDE = re.compile(r'#\s*include\s+(?P<DELIM>["<])(?P<PATH>.+)[">]\s*')
 REGEX_STRING = re.compile(r'"[^"]+"')
+REGEX_IDENTIFIER = re.compile(r"(?<!\w)[a-zA-Z_]\w*")
+REGEX_NAME_NOT_CALLED = re.compile(REGEX_IDENTIFIER.pattern + r"(?!\w)(?!\s*\()")
+REGEX_DEFINED = re.compile(r"\bdefined\s*(?:\(\s*(?P<PAREN_NAME>\w+)\s*\)|(?P<NAME>\w+))")
 
 logger = logging.getLogger("Define Parser")
 
+# the same encoding as `open()` in text mode uses by default
+SOURCE_ENCODING = locale.getpreferredencoding(False)
 
-def glob_recursive(directory, exts=None):
-    exts = exts or [".h", ".H"]
+
+# folders never contain interesting source files
+IGNORED_DIRS = {".git", ".svn", ".hg", "__pycache__", "node_modules"}
+
+SUBPROCESS_KWARGS = {"stderr": subprocess.DEVNULL}
+if os.name == "nt":
+    # remove flashing empty cmd window prompt
+    SUBPROCESS_KWARGS["creationflags"] = subprocess.CREATE_NO_WINDOW
+
+
+def glob_recursive(directory, exts=None, ignored_dirs=IGNORED_DIRS):
+    """walk `directory` once, collect files ending with any of `exts`"""
+    exts = tuple(exts or [".h", ".H"])
     logger.debug("glob **/*.{%s} --recursieve", exts)
-    files = set()
-    for ext in exts:
-        files |= set(Path(directory).rglob("*%s" % ext))
-    return list(files)
+    files = []
+    pending_dirs = [directory]
+    while pending_dirs:
+        try:
+            entries = os.scandir(pending_dirs.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in ignored_dirs:
+                        pending_dirs.append(entry.path)
+                elif entry.name.endswith(exts):
+                    files.append(entry.path)
+    return files
 
 
 def is_git(folder):
@@ -48,28 +143,49 @@ def is_git(folder):
     return len(markers & files)
 
 
+def _git_submodules(directory):
+    """return paths of the initialized submodules directly under `directory`"""
+    if not os.path.isfile(os.path.join(directory, ".gitmodules")):
+        return []
+    git_cmds = ["git", "-C", directory, "config", "--file", ".gitmodules", "-z"]
+    git_cmds += ["--get-regexp", r"^submodule\..*\.path$"]
+    try:
+        output = subprocess.check_output(git_cmds, **SUBPROCESS_KWARGS)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return []
+    submodules = []
+    for record in output.decode("utf-8", "surrogateescape").split("\0"):
+        _, _, path = record.partition("\n")
+        if not path:
+            continue
+        path = os.path.join(directory, path)
+        if os.path.exists(os.path.join(path, ".git")):
+            submodules.append(path)
+    return submodules
+
+
 def git_lsfiles(directory, exts=None, recurse_submodule=False):
     exts = exts or [".h"]
-    git_cmds = ["git", "--git-dir", os.path.join(directory, ".git"), "ls-files"]
-    if recurse_submodule:
-        git_cmds.append("--recurse-submodules")
+    git_cmds = ["git", "-C", directory, "ls-files", "-z", "--"]
+    git_cmds += ["*%s" % ext for ext in exts]
     logger.debug(" ".join(git_cmds))
     try:
-        filelist_output = subprocess.check_output(
-            git_cmds,
-            shell=True,  # remove flashing empty cmd window prompt
-        )
-    except subprocess.CalledProcessError:
-        # fallback to normal glob if git command fail
-        return glob_recursive(directory, exts)
-    except FileNotFoundError:
+        filelist_output = subprocess.check_output(git_cmds, **SUBPROCESS_KWARGS)
+    except (subprocess.CalledProcessError, FileNotFoundError):
         # fallback to normal glob if git command fail
         return glob_recursive(directory, exts)
 
-    folder = Path(directory)
-    filelist = filelist_output.decode().split("\n")
-    filelist = [folder / filename for filename in filelist]
-    return [f for f in filelist if f.suffix in exts]
+    filelist = [
+        os.path.join(directory, filename)
+        for filename in filelist_output.decode("utf-8", "surrogateescape").split("\0")
+        if filename
+    ]
+    if recurse_submodule:
+        submodules = _git_submodules(directory)
+        with ThreadPoolExecutor() as pool:
+            for files in pool.map(lambda d: git_lsfiles(d, exts, True), submodules):
+                filelist += files
+    return filelist
 
 
 
@@ -87,36 +203,432 @@ REGEX_MACRO_HASH_OP = re.compile(r"\s*#\s*(?P<ARG>[^\s]+)")
 REGEX_MACRO_VA_ARGS = re.compile(r"(?:(,)\s*##\s*)?__VA_ARGS__")
 
 
+# checked in this order, "-I" is a prefix of nothing else here
+INCLUDE_FLAGS = ("-iquote", "-isystem", "-I")
+
+
+def iter_include_flags(compile_flags: list):
+    """yield (flag, path) for -I/-iquote/-isystem options, ie: `-Iinc`, `-I inc`"""
+    args = iter(arg for arg in compile_flags if arg)
+    for arg in args:
+        for flag in INCLUDE_FLAGS:
+            if arg.startswith(flag):
+                path = arg[len(flag):] or next(args, "")
+                if path:
+                    yield flag, path
+                break
+
+
+CompileFlags = namedtuple("CompileFlags", ["defines", "include_flags"])  # tuples of (name, value), (flag, path)
+
+
+def parse_compile_args(args: list, directory="") -> CompileFlags:
+    """take -D and include path options of one compiler command line, paths are based on `directory`"""
+    defines = []
+    args_iter = iter(args)
+    for arg in args_iter:
+        if arg.startswith("-D"):
+            # ie: -DDEBUG, -DDEBUG=0, -D DEBUG
+            name, _, value = (arg[2:] or next(args_iter, "")).partition("=")
+            if name:
+                defines.append((name, value or "1"))
+    include_flags = [
+        (flag, os.path.normpath(os.path.join(directory, path)))
+        for flag, path in iter_include_flags(args)
+    ]
+    return CompileFlags(tuple(defines), tuple(include_flags))
+
+
+class CompilationDatabase:
+    """translation units of a compile_commands.json, grouped by identical compile flags"""
+
+    def __init__(self):
+        self.flag_sets = []  # list[CompileFlags], index is the flag set ID
+        self._flag_set_ids = {}  # dict[CompileFlags, flag set ID]
+        self._file_flag_sets = {}  # dict[normalized source path, flag set ID]
+
+    @classmethod
+    def load(cls, json_file):
+        db = cls()
+        with open(json_file, "r", encoding="utf-8") as fs:
+            entries = json.load(fs)
+        for entry in entries:
+            directory = entry.get("directory", "")
+            if "arguments" in entry:
+                args = entry["arguments"]
+            else:
+                args = shlex.split(entry.get("command", ""), posix=os.name != "nt")
+            filepath = os.path.join(directory, entry.get("file", ""))
+            db.add_translation_unit(filepath, parse_compile_args(args, directory))
+        logger.debug(
+            "%d translation units with %d unique flag sets in %s",
+            len(db._file_flag_sets),
+            len(db.flag_sets),
+            json_file,
+        )
+        return db
+
+    @staticmethod
+    def _file_key(filepath):
+        return os.path.normcase(os.path.normpath(filepath))
+
+    def add_translation_unit(self, filepath, flags: CompileFlags):
+        flag_set_id = self._flag_set_ids.get(flags)
+        if flag_set_id is None:
+            flag_set_id = self._flag_set_ids[flags] = len(self.flag_sets)
+            self.flag_sets.append(flags)
+        self._file_flag_sets[self._file_key(filepath)] = flag_set_id
+
+    def flags_of(self, filepath) -> CompileFlags:
+        """return the compile flags of `filepath`, None if it is not a known translation unit"""
+        flag_set_id = self._file_flag_sets.get(self._file_key(filepath))
+        if flag_set_id is None:
+            return None
+        return self.flag_sets[flag_set_id]
+
+    @staticmethod
+    def flags_key(flags: CompileFlags) -> str:
+        """stable short name of a flag set, ie: for cache file names"""
+        return hashlib.sha1(repr(flags).encode()).hexdigest()[:16]
+
+
 class DuplicatedIncludeError(Exception):
     """assert when parser can not found ONE valid include header file."""
 
 
-IncludeHeader = namedtuple("IncludeHeader", ["inc_path", "src_file"])
+IncludeHeader = namedtuple("IncludeHeader", ["inc_path", "src_file"])  # src_file: file ID
+
+
+class FileTable:
+    """canonical integer ID for each file, symlinks of a path spelling are resolved only once"""
+
+    def __init__(self):
+        self._paths = [""]  # list[canonical path], ID 0 is for "no file"
+        self._ids = {"": 0}  # dict[canonical path, ID]
+        self._aliases = {"": 0}  # dict[any path spelling, ID]
+        self._lock = threading.Lock()  # builder and readers may intern new paths together
+
+    def __getstate__(self):
+        with self._lock:  # readers may intern paths while the builder pickles
+            return {
+                "_paths": list(self._paths),
+                "_ids": dict(self._ids),
+                "_aliases": dict(self._aliases),
+            }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._paths)
+
+    def intern(self, filepath) -> int:
+        try:
+            return self._aliases[filepath]
+        except KeyError:
+            pass
+        canonical = os.path.realpath(str(filepath))
+        key = os.path.normcase(canonical)
+        with self._lock:
+            file_id = self._ids.get(key)
+            if file_id is None:
+                file_id = self._ids[key] = len(self._paths)
+                self._paths.append(sys.intern(canonical))
+            self._aliases[filepath] = file_id
+        return file_id
+
+    def path(self, file_id: int) -> str:
+        return self._paths[file_id]
+
+
+class NameIndex:
+    """sorted define names for prefix lookups, built for one published define table"""
+
+    def __init__(self, names, generation=0):
+        self.names = sorted(names)
+        self.generation = generation
+
+    def __len__(self):
+        return len(self.names)
+
+    def prefixed(self, prefix, limit=None) -> list:
+        """names starting with `prefix` in sorted order, at most `limit` of them"""
+        names = self.names
+        start = bisect_left(names, prefix)
+        if not prefix:
+            end = len(names)
+        else:
+            end = bisect_left(names, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        if limit is not None:
+            end = min(end, start + limit)
+        return names[start:end]
+
+
+class DefineGraph:
+    """names referenced by each define body, and the reverse references"""
+
+    def __init__(self, defines=(), generation=0):
+        self.generation = generation
+        self.refs = {}  # dict[name, tuple of names in its body]
+        self.users = defaultdict(set)  # dict[name, set of define names referencing it]
+        for define in defines:
+            self.add(define)
+
+    def copy(self):
+        graph = DefineGraph(generation=self.generation)
+        graph.refs = self.refs.copy()
+        graph.users.update((name, set(users)) for name, users in self.users.items())
+        return graph
+
+    def add(self, define):
+        """record the references of `define`, in place of the ones of its name"""
+        self.remove(define.name)
+        names = set(REGEX_TOKEN.findall(define.token))
+        if define.params:
+            names.difference_update(define.params)
+        names.discard(define.name)
+        self.refs[define.name] = tuple(names)
+        for name in names:
+            self.users[name].add(define.name)
+
+    def remove(self, name):
+        for ref in self.refs.pop(name, ()):
+            users = self.users.get(ref)
+            if users is not None:
+                users.discard(name)
+
+    @staticmethod
+    def _closure(edges, names) -> set:
+        found = set()
+        stack = list(names)
+        while stack:
+            for name in edges.get(stack.pop(), ()):
+                if name not in found:
+                    found.add(name)
+                    stack.append(name)
+        return found
+
+    def dependencies(self, name) -> set:
+        """names `name` transitively refers to"""
+        return self._closure(self.refs, (name,))
+
+    def dependents(self, names) -> set:
+        """defines transitively referring to any of `names`"""
+        return self._closure(self.users, names)
+
 
 class CodeActiveState:
     """active state of a code region inside #if/... directives"""
 
     def __init__(self, condition):
         self._active = bool(condition)
+        self._taken = self._active  # a branch of the #if/#elif chain was active already
 
     def __bool__(self) -> bool:
         return self._active
 
     def meet_elif(self, condition):
-        if self._active:
-            self._active = False
-        else:
-            self._active = bool(condition)
+        self._active = not self._taken and bool(condition)
+        self._taken = self._taken or self._active
 
     def meet_else(self):
-        self._active = not self._active
+        self._active = not self._taken
+        self._taken = True
+
+
+class _Undefined:
+    """placeholder hiding an #undef-ed name of the base environment in a scoped one"""
+
+    def __bool__(self):
+        raise NameError("undefined name")
+
+
+EXPR_CACHE_SIZE = 65536  # translated expressions kept by `compile_c_expr()`
+NOT_NUM_CACHE_SIZE = 65536  # tokens kept by `CDefineEnv.try_eval_num()` known not to be numbers
+
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def compile_c_expr(token):
+    """code object evaluating C expression `token` in Python, None if it is not valid Python"""
+    try:
+        # a leading `!` turns into " not", which is an unexpected indent
+        return compile(convert_op_c2py(token).strip(), "<define>", "eval")
+    except (SyntaxError, ValueError):
+        return None
+
+
+def _define_code(define: Define) -> str:
+    if define.params is None:
+        return "%s = %s" % (define.name, convert_op_c2py(define.token))
+    return "def %s(%s): return %s" % (define.name, ",".join(define.params), define.token)
+
+
+class _LazyNamespace(dict):
+    """namespace compiling the recorded defines on their first lookup
+
+    `base`: namespace looked up for the names missing in this one, if this is the layer of a scope.
+    The defines compiled in a layer see the names of the layer and of its bases. Once the layer
+    redefines or undefines a name of `base`, the defines of `base` are compiled in the layer too.
+    """
+
+    def __init__(self, base=None):
+        super().__init__()
+        self.base = base
+        self.pending = {}  # dict[name, Define] not compiled yet
+        self.compiled = {}  # dict[name, Define] compiled
+        self.failed = {}  # dict[name, Define] failed to compile, ie: a name it uses was not defined
+        self.graph = DefineGraph()  # references of the compiled and failed defines
+        self.shadows_base = False  # a name of `base` is redefined or undefined in this layer
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def copy(self):
+        namespace = _LazyNamespace(self.base)
+        namespace.update(self)
+        namespace.pending = self.pending.copy()
+        namespace.compiled = self.compiled.copy()
+        namespace.failed = self.failed.copy()
+        namespace.graph = self.graph.copy()
+        namespace.shadows_base = self.shadows_base
+        return namespace
+
+    def __missing__(self, name):
+        with self.lock:
+            if dict.__contains__(self, name):  # compiled by another thread meanwhile
+                return dict.__getitem__(self, name)
+            define = self._take_pending(name)
+            if define is None:
+                if self.base is None or name in self.failed:
+                    raise KeyError(name)
+                return self.base[name]
+            self._compile_chain(name, define)
+            if name in self.failed:
+                raise KeyError(name)
+            return dict.__getitem__(self, name)
+
+    def _take_pending(self, name):
+        """Define of `name` to compile in this namespace, removed from `pending`"""
+        define = self.pending.pop(name, None)
+        if define is None and self.shadows_base and name not in self.failed:
+            define = self.base.find_define(name)
+        return define
+
+    def _compile_chain(self, name, define):
+        """compile `define` after the pending defines it uses, deepest first
+
+        Compiling them on their lookups would take a stack frame for each define of the chain.
+        """
+        stack = [(name, define, False)]
+        taken = {name: define}  # removed from `pending`, not compiled yet
+        path = set()  # names whose dependencies are being compiled, a cycle back to them fails
+        while stack:
+            name, define, deps_pushed = stack.pop()
+            if name not in taken:  # compiled for another define of the chain already
+                continue
+            if not deps_pushed:
+                path.add(name)
+                stack.append((name, define, True))
+                for dep in set(REGEX_TOKEN.findall(define.token)).difference(define.params or ()):
+                    if dep in path or dict.__contains__(self, dep):
+                        continue
+                    dep_define = taken.get(dep) or self._take_pending(dep)
+                    if dep_define is not None:
+                        taken[dep] = dep_define
+                        stack.append((dep, dep_define, False))
+                continue
+            path.discard(name)
+            del taken[name]
+            self.graph.add(define)
+            try:
+                exec(_define_code(define), self)
+            except Exception:
+                self.failed[name] = define
+            else:
+                self.compiled[name] = define
+
+    def forget(self, name):
+        """drop `name`, and compile the defines using it again on their next lookup
+
+        An object-like define is compiled to its value, which is stale once a name it
+        uses is redefined or undefined. The failed ones may compile once a name is added.
+        """
+        with self.lock:
+            dict.pop(self, name, None)
+            self.pending.pop(name, None)
+            self.compiled.pop(name, None)
+            self.failed.pop(name, None)
+            if name not in self.graph.users:
+                self.graph.remove(name)
+                return
+            users = self.graph.dependents((name,))
+            self.graph.remove(name)
+            for user in users:
+                define = self.compiled.pop(user, None) or self.failed.pop(user, None)
+                if define is not None:
+                    dict.pop(self, user, None)
+                    self.pending[user] = define
+                    self.graph.remove(user)
+
+    def find_define(self, name):
+        """Define of `name` in this namespace or its bases, None for the names not from a define"""
+        namespace = self
+        while namespace is not None:
+            define = (
+                namespace.pending.get(name) or namespace.compiled.get(name) or namespace.failed.get(name)
+            )
+            if define is not None:
+                return define
+            namespace = namespace.base
+        return None
+
+    def has_name(self, name) -> bool:
+        """`name` is in this namespace or its bases, compiled or not"""
+        namespace = self
+        while namespace is not None:
+            if dict.__contains__(namespace, name) or name in namespace.pending:
+                return True
+            namespace = namespace.base
+        return False
 
 
 class CDefineEnv:
-    def __init__(self):
-        self._globals = {}  # use for eval
+    def __init__(self, stats: BuildStats = None):
+        self._globals = _LazyNamespace()  # use for eval
+        self._parent = None  # environment this one evaluates over, see `scoped()`
+        self._version = 0  # changed whenever names are added or deleted
+        self._not_num = {}  # dict[token, `_versions()` the evaluation failed at]
+        self.stats = stats or BuildStats()
+
+    def copy(self):
+        env = CDefineEnv(self.stats)
+        env._globals = self._globals.copy()
+        env._parent = self._parent
+        return env
+
+    def scoped(self, stats: BuildStats = None):
+        """new environment evaluating over this one, but defining names only in its own layer"""
+        env = CDefineEnv(stats or self.stats)
+        env._globals = _LazyNamespace(self._globals)
+        env._parent = self
+        return env
+
+    def _versions(self):
+        """`_version` of this environment and of the ones it evaluates over"""
+        if self._parent is None:
+            return self._version
+        return (self._version, self._parent._versions())
 
     def add_expr(self, code):
+        self._version += 1
         try:
             exec(code, self._globals)
         except NameError:
@@ -127,25 +639,40 @@ class CDefineEnv:
             pass
 
     def add_define(self, define: Define):
-        if define.params is None:
-            code = "%s = %s" % (define.name, convert_op_c2py(define.token))
-            self.add_expr(code)
-        else:
-            code = "def %s(%s): return %s" % (define.name, ",".join(define.params), define.token)
-            self.add_expr(code)
+        """record `define`, it is compiled when it is looked up for the first time"""
+        self._version += 1
+        namespace = self._globals
+        namespace.forget(define.name)
+        namespace.pending[define.name] = define
+        if namespace.base is not None and namespace.base.has_name(define.name):
+            namespace.shadows_base = True
 
     def del_name(self, name):
-        try:
-            exec("del %s" % name, self._globals)
-        except NameError:
-            pass
+        self._version += 1
+        namespace = self._globals
+        namespace.forget(name)
+        if namespace.base is not None and namespace.base.has_name(name):
+            namespace[name] = _Undefined()
+            namespace.shadows_base = True
 
     def try_eval_num(self, token):
-        token = convert_op_c2py(token)
-        try:
-            return int(eval(token, self._globals))
-        except:
+        if _is_number(token):
+            return int(token)
+        not_num = self._not_num
+        version = self._version if self._parent is None else self._versions()
+        if not_num.get(token) == version:
             return None
+        code = compile_c_expr(token)
+        if code is not None:
+            try:
+                return int(eval(code, self._globals))
+            except:
+                pass
+        self.stats.count("eval_failures")
+        if len(not_num) >= NOT_NUM_CACHE_SIZE:
+            not_num.clear()
+        not_num[token] = version
+        return None
 
     def stringify_token(self, line: str, old_params: list = None) -> str:
         expanded_token = line
@@ -159,12 +686,55 @@ class CDefineEnv:
         return expanded_token
 
 
-def has_defined(define: Define, curr_file, curr_line):
+class DefineScope(MutableMapping):
+    """copy-on-write layer of defines, the `base` dict is never modified through it"""
+
+    def __init__(self, base):
+        self.base = base
+        self.local = {}  # dict[name, Define] added in this scope
+        self.hidden = set()  # names of `base` undefined in this scope
+
+    def __getitem__(self, name):
+        try:
+            return self.local[name]
+        except KeyError:
+            pass
+        if name in self.hidden:
+            raise KeyError(name)
+        return self.base[name]
+
+    def __contains__(self, name):
+        return name in self.local or (name in self.base and name not in self.hidden)
+
+    def __setitem__(self, name, define):
+        self.local[name] = define
+        self.hidden.discard(name)
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self.local.pop(name, None)
+        if name in self.base:
+            self.hidden.add(name)
+
+    def __iter__(self):
+        yield from self.local
+        for name in self.base:
+            if name not in self.local and name not in self.hidden:
+                yield name
+
+    def __len__(self):
+        new_names = sum(1 for name in self.local if name not in self.base)
+        return len(self.base) + new_names - len(self.hidden)
+
+
+def has_defined(define: Define, curr_file: int, curr_line):
+    """`curr_file`: file ID from `Parser.files`"""
     defined_file = define.file
     defined_line = define.lineno
     if (
         defined_file
-        and os.path.samefile(defined_file, curr_file)
+        and defined_file == curr_file
         and curr_line < defined_line
     ):
         return False
@@ -236,6 +806,24 @@ def _argument_replacement(t: Token, new_token: str, line: str):
     return expanded_token
 
 
+def changed_define_names(old_defs, new_defs) -> set:
+    """names defined in only one of `old_defs` and `new_defs`, or with other params or body"""
+    changed = set(old_defs.keys() ^ new_defs.keys())
+    for name, define in new_defs.items():
+        old = old_defs.get(name)
+        if old is not None and (old.params != define.params or old.token != define.token):
+            changed.add(name)
+    return changed
+
+
+def discover_header_files(directory, exts, recurse_submodule=False) -> list:
+    if is_git(directory):
+        header_files = git_lsfiles(directory, exts, recurse_submodule)
+    else:
+        header_files = glob_recursive(directory, exts)
+    return [os.path.normpath(f) for f in header_files]
+
+
 def _search_included_file(header_files: list, inc_path, src_file):
     inc_path = os.path.normpath(inc_path)  # xxx/conf.h
     src_file = os.path.normpath(src_file)  # C:/path/to/src.xxx.c
@@ -262,31 +850,52 @@ def _search_included_file(header_files: list, inc_path, src_file):
         return None
 
 
+# bump when the pickled Parser layout changes, older cache files get rebuilt
+CACHE_VERSION = 14
+
+_GENERATIONS = itertools.count(1)
+
+
 class Parser:
+    expand_limits = ExpandLimits(depth=256, steps=20000, timeout=1.0)  # of `expand_token()`
+
     def __init__(self):
+        self.version = CACHE_VERSION
+        self.generation = 0  # identifies published define tables, see `publish()`/`snapshot()`
+        self.partial = False  # True for snapshots taken before the building is done
+        self.files = FileTable()
         self.reset()
-        self.filelines = defaultdict(list)
+        self.filelines = {}  # dict[file ID, array of sorted #define line numbers]
 
     def reset(self):
-        self.cdef = CDefineEnv()
+        self.stats = BuildStats()
+        self.cdef = CDefineEnv(self.stats)
         self.defs = {}  # dict of Define
         self.zero_defs = set()
         self.folder = ""
-        self.include_trees = defaultdict(list)  # dict[filename: str, include_files: list[str]]
+        self.include_trees = defaultdict(list)  # dict[file ID, list[IncludeHeader]]
         self.header_files = []
-        self.temp_defs = defaultdict(set)
+        self.temp_defs = defaultdict(dict)  # dict[file ID, dict[name, Define]]
+        self.values = {}  # dict[name, int] of object-like defines, see `build_value_table()`
         self.recurse_submodule = False
+        self.quote_include_paths = []  # -iquote
+        self.include_paths = []  # -I
+        self.system_include_paths = []  # -isystem
+        self._include_cache = {}  # dict[(including dir, include spelling, quoted), path]
+        self._parsed_lines = {}  # dict[file ID, array of #define line numbers] of files parsed after building
+        self._name_index = None  # NameIndex of `defs`, see `name_index()`
+        self._graph = None  # DefineGraph of `defs`, see `dependency_graph()`
+        self.const_conditions = {}  # dict[#if condition without identifiers, value]
 
     def insert_define(self, name, *, params=None, token=None, filename="", lineno=0):
-        """params: list of parameters required, token: define body"""
-        new_params = params or []
+        """params: list of parameters required, None for object-like define, token: define body"""
         new_token = token or ""
         define = Define(
             name=name,
-            params=new_params,
+            params=params,
             token=new_token,
             line="",
-            file=filename,
+            file=self.files.intern(filename),
             lineno=lineno,
         )
         self._insert_define(define)
@@ -306,17 +915,221 @@ class Parser:
             raise KeyError("token '{}' is not defined!".format(name))
 
     def insert_temp_define(self, name, *, params=None, token=None, filename="", lineno=0):
+        """temporary define of `filename`, only visible to `scoped(filename)` parsers"""
         logger.debug("insert temp define: %s", name)
-        self.temp_defs[filename].add(name)
-        self.insert_define(name, params=params, token=token, filename=filename, lineno=lineno)
+        file_id = self.files.intern(filename)
+        self.temp_defs[file_id][name] = Define(
+            name=name,
+            params=params,
+            token=token or "",
+            file=file_id,
+            lineno=lineno,
+        )
 
     def remove_temp_define(self, filename):
-        logger.debug("remove %d temp defines", len(self.temp_defs[filename]))
-        for name in self.temp_defs[filename]:
-            if name in self.defs:
-                del self.defs[name]
-                self.cdef.del_name(name)
-        self.temp_defs[filename] = set()
+        temp_defs = self.temp_defs.pop(self.files.intern(filename), {})
+        logger.debug("remove %d temp defines", len(temp_defs))
+
+    def overlay(self):
+        """shallow copy holding its own temporary defines, over the untouched define tables"""
+        p = copy.copy(self)
+        p.temp_defs = defaultdict(dict)
+        return p
+
+    def publish(self):
+        """mark the define tables complete, they must not be modified afterwards"""
+        self.generation = next(_GENERATIONS)
+        self.partial = False
+        return self
+
+    def snapshot(self):
+        """frozen copy of the define tables built so far, `self` can keep building"""
+        snap = copy.copy(self)
+        snap.defs = dict(self.defs)
+        snap.cdef = self.cdef.copy()
+        snap.zero_defs = set(self.zero_defs)
+        snap.include_trees = defaultdict(
+            list, {file_id: list(headers) for file_id, headers in self.include_trees.items()}
+        )
+        snap.filelines = dict(self.filelines)
+        snap._parsed_lines = {}
+        snap.temp_defs = defaultdict(dict)
+        snap.values = {}
+        snap.generation = next(_GENERATIONS)
+        snap.partial = True
+        return snap
+
+    def build_value_table(self, previous=None):
+        """evaluate all object-like defines into `values`, readers may look up while it fills
+
+        `previous`: parser built before this one, its values are reused for the defines which
+        did not change, neither by themselves nor by the names they refer to.
+        """
+        with self.stats.timeit("build_value_table"):
+            defs = self.defs
+            if previous is None or previous.partial:
+                values = {}
+                names = [define.name for define in list(defs.values()) if define.params is None]
+            else:
+                values = dict(previous.values)
+                stale = self.invalidate_values(changed_define_names(previous.defs, defs), values)
+                names = [name for name in stale if name in defs and defs[name].params is None]
+                self.stats.count("values_reused", len(values))
+            self.values = values
+            for name, result in zip(names, self.evaluate_many(names)):
+                if result.value is not None:
+                    values[name] = result.value
+        self.stats.count("table_values", len(values))
+
+    def evaluate_many(self, items) -> list:
+        """EvalResult of each macro name or expression in `items`, in the same order
+
+        Expansions of object-like macros are shared by all the items.
+        """
+        memo = {}  # see `expand_token()`
+
+        def evaluate(item):
+            define = self.defs.get(item)
+            if define is not None:
+                if define.params is not None:
+                    return EvalResult(define.token, None)
+                value = self.values.get(item)
+                if value is not None:
+                    return EvalResult(str(value), value)
+                token = define.token
+            else:
+                token = item
+            expanded = self.expand_token(token, memo=memo)
+            return EvalResult(expanded, self.cdef.try_eval_num(expanded))
+
+        with self.stats.timeit("evaluate_many"):
+            return [evaluate(item) for item in items]
+
+    def name_index(self) -> NameIndex:
+        """NameIndex of the project defines, built once per published generation"""
+        index = self._name_index
+        if index is None or index.generation != self.generation:
+            with self.stats.timeit("build_name_index"):
+                index = NameIndex(list(self.defs.keys()), self.generation)
+            self._name_index = index
+        return index
+
+    def dependency_graph(self) -> DefineGraph:
+        """DefineGraph of the project defines, built once per published generation"""
+        graph = self._graph
+        if graph is None or graph.generation != self.generation:
+            with self.stats.timeit("build_dependency_graph"):
+                graph = DefineGraph(list(self.defs.values()), self.generation)
+            self._graph = graph
+        return graph
+
+    def build_lookups(self):
+        """build `name_index()` and `dependency_graph()` ahead, ie: in the building thread,
+        so the readers only look them up"""
+        self.name_index()
+        self.dependency_graph()
+        return self
+
+    def has_lookups(self) -> bool:
+        """True when `name_index()` and `dependency_graph()` are built for this generation"""
+        index, graph = self._name_index, self._graph
+        return (
+            index is not None
+            and index.generation == self.generation
+            and graph is not None
+            and graph.generation == self.generation
+        )
+
+    def invalidate_values(self, names, values=None) -> set:
+        """drop `names` and the defines depending on them from `values` (default: `self.values`)
+
+        return the dropped names.
+        """
+        values = self.values if values is None else values
+        names = set(names)
+        names |= self.dependency_graph().dependents(names)
+        for name in names:
+            values.pop(name, None)
+        return names
+
+    def find_defines(self, prefix, limit=None) -> list:
+        """project defines whose name starts with `prefix`, sorted by name"""
+        defs = self.defs
+        return [defs[name] for name in self.name_index().prefixed(prefix, limit) if name in defs]
+
+    def is_defined(self, name, filepath=""):
+        return name in self.defs or name in self.temp_defs.get(self.files.intern(filepath), {})
+
+    def get_cached_value(self, name, filepath=""):
+        """precomputed value of `name` from `values`
+
+        None if it is not there, or if `name` depends on a temporary define of `filepath`,
+        so the value may differ in that file.
+        """
+        value = self.values.get(name)
+        if value is None or not filepath:
+            return value
+        temp_defs = self.temp_defs.get(self.files.intern(filepath))
+        if not temp_defs:
+            return value
+        if name in temp_defs or not temp_defs.keys().isdisjoint(self.dependency_graph().dependencies(name)):
+            return None
+        return value
+
+    def scoped(self, filepath=""):
+        """shallow copy of the parser, new defines go to a layer over the untouched project defines
+
+        temporary defines of `filepath` are already in the layer.
+        """
+        scope = copy.copy(self)
+        # readers of a published parser do not add into the statistics of its building
+        scope.stats = BuildStats()
+        scope.defs = DefineScope(self.defs)
+        scope.cdef = self.cdef.scoped(scope.stats)
+        scope.zero_defs = set(self.zero_defs)
+        scope.values = {}  # values of the project defines may not hold in the scope
+        if filepath:
+            for define in self.temp_defs.get(self.files.intern(filepath), {}).values():
+                scope._insert_define(define)
+        return scope
+
+    def add_include_path(self, path, flag="-I", base_dir=""):
+        """append a search path of `#include` like the compiler flag does"""
+        path = os.path.normpath(os.path.join(base_dir, path))
+        if flag == "-iquote":
+            self.quote_include_paths.append(path)
+        elif flag == "-isystem":
+            self.system_include_paths.append(path)
+        else:
+            self.include_paths.append(path)
+        self._include_cache.clear()
+
+    def resolve_include(self, inc_path, src_file, quoted=True):
+        """find the file of `#include "inc_path"` (or <inc_path> if not `quoted`) in `src_file`
+
+        search paths are looked up in the compiler order, the heuristic search over
+        `header_files` is only the fallback.
+        """
+        src_dir = os.path.dirname(str(src_file))
+        key = (src_dir, inc_path, quoted)
+        try:
+            return self._include_cache[key]
+        except KeyError:
+            pass
+
+        search_dirs = [src_dir] + self.quote_include_paths if quoted else []
+        search_dirs += self.include_paths + self.system_include_paths
+        for directory in search_dirs:
+            candidate = os.path.normpath(os.path.join(directory, inc_path))
+            if os.path.isfile(candidate):
+                included_file = candidate
+                break
+        else:
+            self.stats.count("include_fallbacks")
+            with self.stats.timeit("search_included_file"):
+                included_file = _search_included_file(self.header_files, inc_path, src_file)
+        self._include_cache[key] = included_file
+        return included_file
 
     def read_file_lines(
         self,
@@ -324,9 +1137,60 @@ class Parser:
         try_if_else=True,
         ignore_header_guard=False,
         reserve_whitespace=False,
+    ):
+        clean_code = self.stats.timed_iter("remove_comment", remove_comment(fileio))
+        yield from self._read_numbered_lines(
+            enumerate(clean_code, 1),
+            fileio.name,
+            try_if_else,
+            ignore_header_guard,
+            reserve_whitespace,
+        )
+
+    def read_directive_lines(self, filepath, try_if_else=True, ignore_header_guard=False, scanned=None):
+        """same as `read_file_lines`, but only the directive lines of the file are decoded and yielded
+
+        `scanned`: dict[file path, list of (line number, text)] of the directive lines scanned
+        already, shared by the parsers of several configurations; files scanned here are added.
+        """
+        if scanned is not None:
+            directives = scanned.get(filepath)
+            if directives is None:
+                directives = scanned[filepath] = list(self._scan_directive_lines(filepath))
+            yield from self._read_numbered_lines(
+                iter(directives), str(filepath), try_if_else, ignore_header_guard
+            )
+            return
+        yield from self._read_numbered_lines(
+            self._scan_directive_lines(filepath), str(filepath), try_if_else, ignore_header_guard
+        )
+
+    def _scan_directive_lines(self, filepath):
+        """yield (line number, text) of the directive lines in file `filepath`"""
+        with open(filepath, "rb") as fs:
+            try:
+                buf = mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file can not be mapped
+                return
+            with buf:
+                yield from self.stats.timed_iter(
+                    "scan_directives", iter_directive_lines(buf, SOURCE_ENCODING)
+                )
+
+    def _read_numbered_lines(
+        self,
+        numbered_lines,
+        filename,
+        try_if_else=True,
+        ignore_header_guard=False,
+        reserve_whitespace=False,
     ):
         captured_ifs = []
+        file_id = self.files.intern(filename)
         def is_active(single_line: str = "") -> bool:
+            if not single_line.lstrip().startswith("#"):
+                return all(bool(active) for active in captured_ifs)
             match_if = REG_STATEMENT_IF.match(single_line)
             match_ifdef = REG_STATEMENT_IFDEF.match(single_line)
             match_ifndef = REG_STATEMENT_IFNDEF.match(single_line)
@@ -335,12 +1199,16 @@ class Parser:
             match_endif = REG_STATEMENT_ENDIF.match(single_line)
             top_visible_level = all(bool(active) for active in captured_ifs)
             if match_if:
-                if_token_val = self.expand_token(match_if.group("TOKEN"))
-                captured_ifs.append(CodeActiveState(self.cdef.try_eval_num(if_token_val)))
+                if top_visible_level:
+                    condition = self.eval_condition(match_if.group("TOKEN"), file_id, line_no)
+                    captured_ifs.append(CodeActiveState(condition))
+                else:
+                    # inside a dead block, the condition can not make any line active
+                    captured_ifs.append(CodeActiveState(False))
             elif match_ifdef:
                 check_name = match_ifdef.group("TOKEN").rstrip()
                 if check_name in self.defs:
-                    has_def = has_defined(self.defs[check_name], fileio.name, line_no)
+                    has_def = has_defined(self.defs[check_name], file_id, line_no)
                 else:
                     has_def = False
                 captured_ifs.append(CodeActiveState(has_def))
@@ -348,18 +1216,21 @@ class Parser:
                 if ignore_header_guard and captured_ifs == []:
                     captured_ifs.append(CodeActiveState(True))
                 else:
-                    if fileio.name.endswith(".h") and captured_ifs == []:
+                    if filename.endswith(".h") and captured_ifs == []:
                         has_def = False
                     else:
                         check_name = match_ifndef.group("TOKEN").rstrip()
                         if check_name in self.defs:
-                            has_def = has_defined(self.defs[check_name], fileio.name, line_no)
+                            has_def = has_defined(self.defs[check_name], file_id, line_no)
                         else:
                             has_def = False
                     captured_ifs.append(CodeActiveState(not has_def))
             elif match_elif:
-                if_token_val = self.expand_token(match_elif.group("TOKEN"))
-                captured_ifs[-1].meet_elif(self.cdef.try_eval_num(if_token_val))
+                if all(bool(active) for active in captured_ifs[:-1]):
+                    condition = self.eval_condition(match_elif.group("TOKEN"), file_id, line_no)
+                    captured_ifs[-1].meet_elif(condition)
+                else:
+                    captured_ifs[-1].meet_elif(False)
             elif match_else:
                 captured_ifs[-1].meet_else()
             elif match_endif:
@@ -368,25 +1239,69 @@ class Parser:
                 else:
                     # some source files may tend to leave an extra #endif at the end
                     # I think it is for unintentionally include, so just warn and let it go.
-                    logger.warning("Extra #endif found in {}#{}".format(fileio.name, line_no))
+                    logger.warning("Extra #endif found in {}#{}".format(filename, line_no))
                     return False
             return top_visible_level or all(bool(active) for active in captured_ifs)
 
         merged_line = ""
-        clean_code = remove_comment(fileio.readlines())
-        for line_no, line in enumerate(clean_code, 1):
-
-            merged_line += REGEX_SYNTAX_LINE_BREAK.sub(" ", line.strip())
-            if REGEX_SYNTAX_LINE_BREAK.search(line):
-                if reserve_whitespace:
-                    if is_active():
-                        yield (line, line_no)
-                continue
+        # accumulated here and recorded once per file, a context manager per line is not cheap
+        perf_counter = time.perf_counter
+        is_active_seconds = 0.0
+        is_active_calls = 0
+        try:
+            for line_no, line in numbered_lines:
+
+                merged_line += REGEX_SYNTAX_LINE_BREAK.sub(" ", line.strip())
+                if REGEX_SYNTAX_LINE_BREAK.search(line):
+                    if reserve_whitespace:
+                        if is_active():
+                            yield (line, line_no)
+                    continue
+
+                if not try_if_else:
+                    yield (merged_line, line_no)
+                else:
+                    start = perf_counter()
+                    active = is_active(merged_line)
+                    is_active_seconds += perf_counter() - start
+                    is_active_calls += 1
+                    if active:
+                        yield (merged_line, line_no)
+
+                merged_line = ""
+        finally:
+            if is_active_calls:
+                self.stats.add_time("is_active", is_active_seconds, is_active_calls)
 
-            if not try_if_else or is_active(merged_line):
-                yield (merged_line, line_no)
+    def eval_condition(self, condition, file_id=0, lineno=0):
+        """value of `#if`/`#elif` condition, the ones without any identifier are folded once
 
-            merged_line = ""
+        As the preprocessor does, `defined NAME` is replaced first, and the identifiers
+        left after the expansion are taken as 0. `file_id`, `lineno`: the place of the
+        condition, the defines after it in the same file are not defined yet.
+        """
+        try:
+            return self.const_conditions[condition]
+        except KeyError:
+            pass
+        if REGEX_IDENTIFIER.search(condition) is None:
+            value = self.cdef.try_eval_num(self.expand_token(condition))
+            self.const_conditions[condition] = value
+            self.stats.count("folded_conditions")
+            return value
+
+        def _defined(match):
+            define = self.defs.get(match.group("PAREN_NAME") or match.group("NAME"))
+            return "1" if define is not None and has_defined(define, file_id, lineno) else "0"
+
+        token = self.expand_token(REGEX_DEFINED.sub(_defined, condition))
+        value = self.cdef.try_eval_num(token)
+        if value is None and not isinstance(token, TruncatedToken):
+            token = REGEX_NAME_NOT_CALLED.sub(
+                lambda match: match.group() if match.group() in self.defs else "0", token
+            )
+            value = self.cdef.try_eval_num(token)
+        return value
 
     def _do_define_directive(self, line, filepath="", lineno=0):
         match = REGEX_UNDEF.match(line)
@@ -413,130 +1328,191 @@ class Parser:
         #define BBB()   // params = []
         #define CCC(a)  // params = ['a']
         """
-        self.filelines[filepath].append(lineno)
         return Define(
             name=name,
             params=param_list if parentheses else None,
             token=token,
             line=line,
-            file=filepath,
+            file=self.files.intern(filepath),
             lineno=lineno,
         )
 
-    def read_folder_h(self, directory, try_if_else=True, exts=None):
+    def _index_directive_lines(self, filepath, linenos, index=None):
+        """replace the #define line index of `filepath` by the lines found in its latest parse
+
+        `index`: dict updated instead of `filelines`, for parsing without modifying the define tables.
+        """
+        index = self.filelines if index is None else index
+        index[self.files.intern(filepath)] = array("I", sorted(set(linenos)))
+
+    def active_lines(self, filepath, text=None, is_source=True) -> set:
+        """line numbers active under the define tables, of file `filepath` or its content `text`"""
+        if text is None:
+            with open(filepath, "r", errors="replace") as fs:
+                text = fs.read()
+        fileio = io.StringIO(text)
+        fileio.name = filepath
+        ctx_mgr = self.read_c if is_source else self.read_h
+        with ctx_mgr(filepath, try_if_else=True) as scope:
+            return {
+                lineno
+                for _, lineno in scope.read_file_lines(
+                    fileio,
+                    reserve_whitespace=True,
+                    ignore_header_guard=True,
+                )
+            }
+
+    def get_directive_lines(self, filepath):
+        """sorted #define line numbers of `filepath` found in its latest parse"""
+        file_id = self.files.intern(filepath)
+        lines = self._parsed_lines.get(file_id)
+        if lines is None:
+            lines = self.filelines.get(file_id, ())
+        return lines
+
+    def read_folder_h(
+        self, directory, try_if_else=True, exts=None, on_progress=None, header_files=None, scanned=None
+    ):
+        """`on_progress(done_count, total_count)` is called after each header file on the list
+
+        `header_files`: files found by `discover_header_files()` already, to skip the discovery.
+        `scanned`: directive lines shared with other parsers, see `read_directive_lines()`.
+        """
         exts = exts or [".h"]
         self.folder = directory
 
-        if is_git(directory):
-            header_files = git_lsfiles(directory, exts, self.recurse_submodule)
-        else:
-            header_files = glob_recursive(directory, exts)
-        self.header_files = [os.path.normpath(f) for f in header_files]
+        if header_files is None:
+            with self.stats.timeit("discover_files"):
+                header_files = discover_header_files(directory, exts, self.recurse_submodule)
+        self.header_files = list(header_files)
+        self.stats.count("header_files", len(header_files))
         logger.debug("read_header cnt: %d", len(header_files))
 
         header_done = set()
         pre_defined_keys = self.defs.keys()
+        nested_times = [0.0]  # time spent in included headers, per recursion level
 
         def read_header(filepath):
             if filepath is None or filepath in header_done:
                 return
             header_done.add(filepath)
 
+            start = time.perf_counter()
+            nested_times.append(0.0)
+            directive_lines = []
             try:
-                with open(filepath, "r", errors="replace") as fs:
-                    for line, lineno in self.read_file_lines(fs, try_if_else):
-                        match_include = REGEX_INCLUDE.match(line)
-                        if match_include is not None:
-                            # parse included file first
-                            path = match_include.group("PATH")
-                            included_file = _search_included_file(
-                                self.header_files, path, src_file=filepath
+                for line, lineno in self.read_directive_lines(filepath, try_if_else, scanned=scanned):
+                    match_include = REGEX_INCLUDE.match(line)
+                    if match_include is not None:
+                        # parse included file first
+                        path = match_include.group("PATH")
+                        with self.stats.timeit("resolve_include"):
+                            included_file = self.resolve_include(
+                                path, filepath, match_include.group("DELIM") == '"'
                             )
-                            if included_file:
-                                self.include_trees[os.path.realpath(filepath)].append(
-                                    IncludeHeader(path, os.path.realpath(included_file))
-                                )
-                                read_header(included_file)
-                        define = self._do_define_directive(line, filepath, lineno)
-                        if define is None or define.name in pre_defined_keys:
-                            continue
-                        self._insert_define(define)
-
-            except UnicodeDecodeError as e:
+                        if included_file:
+                            self.include_trees[self.files.intern(filepath)].append(
+                                IncludeHeader(path, self.files.intern(included_file))
+                            )
+                            read_header(included_file)
+                    define = self._do_define_directive(line, filepath, lineno)
+                    if define is None:
+                        continue
+                    directive_lines.append(lineno)
+                    if define.name in pre_defined_keys:
+                        continue
+                    self._insert_define(define)
+            except OSError as e:
                 logger.warning("Fail to open {!r}. {}".format(filepath, e))
-
-        for header_file in header_files:
-            read_header(header_file)
+            finally:
+                self._index_directive_lines(filepath, directive_lines)
+                elapsed = time.perf_counter() - start
+                nested = nested_times.pop()
+                nested_times[-1] += elapsed
+                self.stats.record_file(filepath, elapsed - nested)
+                self.stats.count("headers_read")
+
+        with self.stats.timeit("read_folder_h"):
+            for index, header_file in enumerate(self.header_files, 1):
+                read_header(header_file)
+                if on_progress is not None:
+                    on_progress(index, len(self.header_files))
+        self.stats.count("defines", len(self.defs))
 
         return True
 
     @contextmanager
     def read_h(self, filepath, try_if_else=False):
+        """yield a scoped parser having the defines of header `filepath`, see `read_c`"""
+        scope = self.scoped(filepath)
         try:
             with open(filepath, "r", errors="replace") as fs:
-                for line, _ in self.read_file_lines(fs, try_if_else):
-                    define = self._do_define_directive(line)
+                for line, _ in scope.read_file_lines(fs, try_if_else):
+                    define = scope._do_define_directive(line)
                     if define is None:
                         continue
                     # if len(define.params):
                     #     return
-                    self._insert_define(define)
-            yield
+                    scope._insert_define(define)
         except UnicodeDecodeError as e:
             print("Fail to open :{}. {}".format(filepath, e))
+        yield scope
 
     @contextmanager
     def read_c(self, filepath, try_if_else=False):
-        """use `with` context manager for having temporary tokens defined in .c source file"""
+        """use `with` context manager for having temporary tokens defined in .c source file
+
+        the tokens and includes are only visible to the yielded scoped parser, `self` is left untouched.
+        """
+        scope = self.scoped(filepath)
+        scope.include_trees = defaultdict(list, self.include_trees)
         temp_defs = []
-        temp_hidden = []
+        directive_lines = []
         try:
-            add_includes = os.path.realpath(filepath) not in self.include_trees
+            add_includes = self.files.intern(filepath) not in self.include_trees
             with open(filepath, "r", errors="replace") as fs:
-                for line, line_no in self.read_file_lines(fs, try_if_else):
+                for line, line_no in scope.read_file_lines(fs, try_if_else):
                     if add_includes:
                         match_include = REGEX_INCLUDE.match(line)
                         if match_include is not None:
                             path = match_include.group("PATH")
-                            included_file = _search_included_file(
-                                self.header_files, path, src_file=filepath
-                            )
+                            with scope.stats.timeit("resolve_include"):
+                                included_file = scope.resolve_include(
+                                    path, filepath, match_include.group("DELIM") == '"'
+                                )
                             if included_file:
-                                self.include_trees[os.path.realpath(filepath)].append(
-                                    IncludeHeader(path, os.path.realpath(included_file))
+                                scope.include_trees[self.files.intern(filepath)].append(
+                                    IncludeHeader(path, self.files.intern(included_file))
                                 )
                             continue
-                    define = self._do_define_directive(line, filepath, line_no)
+                    define = scope._do_define_directive(line, filepath, line_no)
                     if define is None:
                         continue
+                    directive_lines.append(line_no)
                     # if len(define.params):
                     #     return
-                    if define.name in self.defs:
-                        temp_hidden.append(self.defs[define.name])
                     temp_defs.append(define)
 
-            for define in temp_defs:
-                self._insert_define(define)
-
-            yield
-
+            self._index_directive_lines(filepath, directive_lines, self._parsed_lines)
         except UnicodeDecodeError as e:
             print("Fail to open :{}. {}".format(filepath, e))
-        finally:
-            for define in temp_defs:
-                if define.name in self.defs:
-                    del self.defs[define.name]
-                self.cdef.del_name(define.name)
-            # restore temp hidden
-            for define in temp_hidden:
-                self._insert_define(define)
-
-    def load_compile_flags(self, compile_flag_txt: str=""):
+
+        for define in temp_defs:
+            scope._insert_define(define)
+        yield scope
+
+    def load_compile_flags(self, compile_flag_txt: str="", base_dir=""):
+        """take -D and -I/-iquote/-isystem options, relative include paths are based on `base_dir`"""
         if compile_flag_txt == "":
             return
 
         compile_flags = " ".join(compile_flag_txt.splitlines()).split(" ")
 
+        for flag, path in iter_include_flags(compile_flags):
+            logger.debug("  include path: %s %s", flag, path)
+            self.add_include_path(path, flag, base_dir)
+
         predefines = []
         for arg in compile_flags:
             if not arg.startswith("-D"):
@@ -554,6 +1530,13 @@ class Parser:
             print("  predefine: {!r}".format(d))
             self.insert_define(d[0], token=d[1])
 
+    def load_flag_set(self, flags: CompileFlags, base_dir=""):
+        for name, value in flags.defines:
+            logger.debug("  predefine: %s=%s", name, value)
+            self.insert_define(name, token=value)
+        for flag, path in flags.include_flags:
+            self.add_include_path(path, flag, base_dir)
+
     def find_tokens(self, token) -> list:
 
         # remove string value in token
@@ -584,15 +1567,25 @@ class Parser:
         else:
             return []
 
-    def expand_token(self, token: str, zero_undefined=False):
+    def expand_token(self, token: str, zero_undefined=False, limits: ExpandLimits = None, memo=None):
+        """expand the macros in `token`, evaluated to a number string when possible
 
+        The expansion stops at `limits` (default `self.expand_limits`) and leaves the
+        remaining macros unexpanded, the result is a TruncatedToken then.
+
+        `memo`: dict[name, number string] of object-like macros, shared by the calls of
+        the same define tables to reuse the expansions of each other.
+        """
         token_val = self.cdef.try_eval_num(token)
         if token_val is not None:
             return str(token_val)
 
+        limits = limits or self.expand_limits
         total_seen = set()
+        token_seen = set()  # macros being expanded by the frames on the stack
 
-        def _expand_token(_token: str, avoid_recursion_set: set):
+        def _expand_token(_token: str):
+            """a frame of the expansion, yields nested tokens to expand and gets them expanded"""
             expanded_token = _token.strip()
             simple_tokens = [t for t in self.find_tokens(expanded_token) if not t.params]
             """
@@ -600,7 +1593,6 @@ class Parser:
             __       __       _
             ALIGN_2N(XX_BASE, 4)
             """
-            token_seen = avoid_recursion_set.copy()
             for _t in simple_tokens:
                 total_seen.add(_t.name)
 
@@ -609,10 +1601,15 @@ class Parser:
                     if not define.params:
                         # TODO: shall check `if define.params is not None`
                         # but hang in unittest, don't know why
-                        new_token = _arguments_expansion(self.cdef, define, _t, False)
-                        token_seen.add(_t.name)
-                        new_token = _expand_token(new_token, token_seen)
-                        token_seen.remove(_t.name)
+                        if memo is not None and _t.name in memo:
+                            new_token = memo[_t.name]
+                        else:
+                            new_token = _arguments_expansion(self.cdef, define, _t, False)
+                            token_seen.add(_t.name)
+                            new_token = yield new_token
+                            token_seen.remove(_t.name)
+                            if memo is not None and define.params is None and _is_number(new_token):
+                                memo[_t.name] = new_token
 
                         expanded_token = _argument_replacement(
                             _t, new_token, expanded_token
@@ -640,7 +1637,7 @@ class Parser:
                 else:
                     new_token = _arguments_expansion(self.cdef, define, _t, True)
                     token_seen.add(_t.name)
-                    new_token = _expand_token(new_token, token_seen)
+                    new_token = yield new_token
                     token_seen.remove(_t.name)
                     expanded_token = _argument_replacement(_t, new_token, expanded_token)
 
@@ -648,7 +1645,7 @@ class Parser:
                 new_tokens = set(t.name for t in self.find_tokens(expanded_token))
                 new_tokens ^= total_seen
                 if len(new_tokens):
-                    expanded_token = _expand_token(expanded_token, token_seen)
+                    expanded_token = yield expanded_token
 
             token_val = self.cdef.try_eval_num(expanded_token)
             if token_val is not None:
@@ -656,20 +1653,51 @@ class Parser:
 
             return expanded_token
 
-        return _expand_token(token, total_seen)
+        truncated = False
+        steps = 0
+        deadline = time.perf_counter() + limits.timeout
+        stack = [_expand_token(token)]
+        result = None
+        while stack:
+            try:
+                nested_token = stack[-1].send(result)
+            except StopIteration as e:
+                stack.pop()
+                result = e.value
+                continue
+
+            steps += 1
+            if not truncated and (
+                len(stack) >= limits.depth
+                or steps >= limits.steps
+                or time.perf_counter() > deadline
+            ):
+                truncated = True
+                self.stats.count("expand_truncated")
+                logger.debug("expansion truncated after %d steps: %s", steps, token)
+            if truncated:
+                result = nested_token
+            else:
+                stack.append(_expand_token(nested_token))
+                result = None
+
+        return TruncatedToken(result) if truncated else result
 
     def get_expand_defines(
         self, filepath, try_if_else=True, ignore_header_guard=True
     ) -> list:
         defines = []
+        directive_lines = []
+        memo = {}  # see `expand_token()`
 
         with open(filepath, "r", errors="replace") as fs:
             for line, lineno in self.read_file_lines(fs, try_if_else, ignore_header_guard):
                 define = self._do_define_directive(line, filepath, lineno)
                 if define is None:
                     continue
+                directive_lines.append(lineno)
                 if define.params is None:
-                    expanded_token = self.expand_token(define.token)
+                    expanded_token = self.expand_token(define.token, memo=memo)
                 else:
                     expanded_token = define.token
                 defines.append(
@@ -678,10 +1706,11 @@ class Parser:
                         params=define.params,
                         token=expanded_token,
                         line=line,
-                        file=filepath,
+                        file=define.file,
                         lineno=lineno,
                     )
                 )
+        self._index_directive_lines(filepath, directive_lines, self._parsed_lines)
         return defines
 
     def get_expand_define(self, macro_name):
@@ -715,9 +1744,116 @@ class Parser:
                 lines.append(line)
         return lines
 
-    @contextmanager
+    def memory_usage(self) -> dict:
+        """dict[component, approximate bytes], objects shared by components count for the first"""
+        seen = set()
+        components = [
+            ("defs", self.defs),
+            ("cdef globals (compiled defines)", self.cdef._globals),
+            ("values", self.values),
+            ("filelines", self.filelines),
+            ("include_trees", self.include_trees),
+            ("header_files", self.header_files),
+            ("files", self.files),
+            ("temp_defs", self.temp_defs),
+            ("name index", self._name_index),
+            ("dependency graph", self._graph),
+            ("include cache", self._include_cache),
+            ("not-a-number cache", self.cdef._not_num),
+            ("const_conditions", self.const_conditions),
+            ("zero_defs", self.zero_defs),
+        ]
+        return {name: deep_sizeof(obj, seen) for name, obj in components}
+
+    def iter_define_records(self, config=""):
+        """yield a dict of each define for `utils.export`, with its evaluated value"""
+        for define in list(self.defs.values()):
+            value = self.values.get(define.name)
+            if value is not None:
+                expanded = str(value)
+            elif define.params is None:
+                expanded = self.expand_token(define.token)
+                value = self.cdef.try_eval_num(expanded)
+            else:
+                expanded = None
+            yield {
+                "name": define.name,
+                "params": None if define.params is None else ",".join(define.params),
+                "body": define.token,
+                "expanded": expanded,
+                "value": value,
+                "file": self.files.path(define.file),
+                "lineno": define.lineno,
+                "config": config,
+            }
+
+    def expand_line(self, line: str) -> str:
+        """`line` of code with the macros used in it expanded"""
+        expanded_line = line
+        for t in self.find_tokens(line):
+            if t.name in self.defs:
+                expanded_line = _argument_replacement(t, self.expand_token(t.line), expanded_line)
+        return expanded_line
+
+    def iter_preprocess_source(self, filepath, text=None, try_if_else=True):
+        """yield (line number, line) of the active code lines of `filepath` with macros expanded
+
+        Directive lines are left out, defines of the file take effect from their own line.
+        `text`: content of the file if it differs from the file on disk.
+        """
+        ignore_header_guard = os.path.splitext(filepath)[1] == ".h"
+        scope = self.scoped()
+        if text is None:
+            fs = open(filepath, "r", errors="replace")
+        else:
+            fs = io.StringIO(text)
+            fs.name = filepath
+        with fs:
+            for line, lineno in scope.read_file_lines(
+                fs,
+                try_if_else,
+                ignore_header_guard,
+                reserve_whitespace=True,
+            ):
+                if REGEX_SYNTAX_LINE_BREAK.search(line):
+                    continue  # yielded again as a whole at the last line
+                if line.lstrip().startswith("#"):
+                    define = scope._do_define_directive(line, filepath, lineno)
+                    if define is not None:
+                        scope._insert_define(define)
+                    continue
+                yield lineno, scope.expand_line(line.rstrip("\n"))
+
     def pickable(self):
-        cdef_backup = self.cdef
-        self.cdef = CDefineEnv()
-        yield self
-        self.cdef = cdef_backup
\ No newline at end of file
+        """shallow copy to pickle, without the caches built again on demand
+
+        The parser may be published already, so it is left untouched for its readers, and the
+        tables readers keep adding to are copied.
+        """
+        p = copy.copy(self)
+        p.cdef = CDefineEnv(self.stats)
+        p.temp_defs = defaultdict(dict)
+        p.const_conditions = dict(self.const_conditions)
+        p._include_cache = {}
+        p._parsed_lines = {}
+        p._name_index = None
+        p._graph = None
+        return p
+
+
+def build_parsers(directory, flag_sets: dict, recurse_submodule=False, exts=None) -> dict:
+    """published Parser of `directory` for each of `flag_sets` (dict[key, CompileFlags])
+
+    The header files are discovered and their directive lines scanned once for all the parsers,
+    each parser only evaluates the scanned lines under its own flags.
+    """
+    header_files = discover_header_files(directory, exts or [".h"], recurse_submodule)
+    scanned = {}  # see `Parser.read_directive_lines()`
+    parsers = {}
+    for key, flags in flag_sets.items():
+        p = Parser()
+        p.recurse_submodule = recurse_submodule
+        p.load_flag_set(flags, directory)
+        p.read_folder_h(directory, exts=exts, header_files=header_files, scanned=scanned)
+        parsers[key] = p.publish()
+    return parsers
@@ -3,14 +3,25 @@ import io
 import logging
 import os
 import pickle
+import queue
 import re
-
+import subprocess
+import threading
+import time
+import tracemalloc
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
 from pathlib import Path
 
 import sublime
 import sublime_plugin
 
 from . import C_DefineParser
+from .utils.cpp_check import compare_with_cpp, flags_to_args, format_compare_report
+from .utils.export import export_jsonl, export_sqlite
+from .utils.stats import format_bytes
 
 formatter = logging.Formatter(fmt="[{name}] {levelname}: {message}", style="{")
 
@@ -39,6 +50,20 @@ def glob_recursive(directory, ext=".c"):
 CACHE_OBJ_FOLDER = os.path.join(sublime.cache_path(), "DefineParser")
 PARSERS = {}
 PARSER_IS_BUILDING = set()
+COMPILE_DBS = {}  # dict[folder, CompilationDatabase]
+FLAG_SET_PARSERS = OrderedDict()  # dict[(folder, flags key), Parser], least recently used first
+FLAG_SET_PARSERS_MAX = 8  # flag set parsers kept in memory, the others are loaded again from cache
+FLAG_SET_LOCK = threading.Lock()  # guards FLAG_SET_PARSERS, published from the building thread
+FLAG_SET_SCANS = {}  # dict[(folder, recurse submodule), (header files, scanned directive lines)]
+FLAG_SET_BUILDS = queue.Queue()  # flag set buildings, run one at a time, see `_queue_building()`
+FLAG_SET_WORKER = None  # thread running FLAG_SET_BUILDS
+DEFINE_ROWS_CACHE = {}  # dict[(parser generation, value count), list[DefineRow]]
+DEFINE_LIST_CHUNK_SIZE = 5000  # lines inserted by one append_define command
+PREPROCESSED_VIEWS = {}  # dict[view ID, (source file, array of source line numbers)]
+VIEW_RESULTS = {}  # dict[view ID, dict[kind, (key, result)]], see `_get_view_result()`
+VIEW_OVERLAYS = {}  # dict[view ID, (parser, temp defines, overlay)], see `_parse_temp_define()`
+PARTIAL_SNAPSHOT_INTERVAL = 2.0  # seconds between publishing partial define tables
+COMPILE_COMMANDS_FILES = ["compile_commands.json", os.path.join("build", "compile_commands.json")]
 
 REGION_INACTIVE_NAME = "inactive_source_code"
 PREDEFINE_FOLDER = ".define_parser_compiler_files"
@@ -50,6 +75,12 @@ DP_SETTING_RESURSE_MODULES = "define_parser_resurse_modules"
 DP_SETTING_ROOT_MARKERS = "define_parser_root_markers"
 DP_SETTING_LOG_DEBUG = "define_parser_debug_log_enable"
 DP_SETTING_COMPILE_FILE = "compile_flag_file"
+DP_SETTING_HOVER_VALUE = "define_parser_hover_value_enable"
+DP_SETTING_COMPLETION = "define_parser_completion_enable"
+DP_SETTING_TRACE_MEMORY = "define_parser_trace_memory"
+DP_SETTING_CPP_COMMAND = "define_parser_cpp_command"
+
+COMPLETION_LIMIT = 1000  # completions offered for one prefix
 
 
 def _escape_filepath(folder):
@@ -57,11 +88,33 @@ def _escape_filepath(folder):
     return folder.translate(trans)
 
 
-def _get_cache_file_for_folder(folder):
-    tag_file = _escape_filepath(folder) + ".dtag"
+def _get_cache_file_for_folder(folder, flags_key=""):
+    tag_file = _escape_filepath(folder) + ("@" + flags_key if flags_key else "") + ".dtag"
     return os.path.join(CACHE_OBJ_FOLDER, tag_file)
 
 
+def _load_parser_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, "rb") as fs:
+            parser = pickle.load(fs)
+    except:
+        return None
+    if getattr(parser, "version", 0) != C_DefineParser.CACHE_VERSION:
+        return None
+    return parser
+
+
+def _save_parser_cache(p, cache_file):
+    with p.stats.timeit("pickle"):
+        obj = pickle.dumps(p.pickable())
+    p.stats.count("cache_bytes", len(obj))
+    with open(cache_file, "wb") as fs:
+        fs.write(obj)
+    logger.debug("cache file saved as {!r}".format(cache_file))
+
+
 def _get_default_settings():
     return sublime.load_settings("DefineParser.sublime-settings")
 
@@ -130,57 +183,218 @@ def _init_parser(window):
         return None
 
     logger.info("init_parser %s", active_folder)
-
-    cache_file = _get_cache_file_for_folder(active_folder)
-    if os.path.exists(cache_file):
-        try:
-            with open(cache_file, "rb") as fs:
-                PARSERS[active_folder] = pickle.load(fs)
-            if _get_setting(window, DP_SETTING_HL_INACTIVE):
-                _mark_inactive_code(window.active_view())
-            return
-        except:
-            pass
+    _load_compile_commands(active_folder)
 
     if active_folder in PARSER_IS_BUILDING:
         return
 
-    PARSER_IS_BUILDING.add(active_folder)
-
     p = C_DefineParser.Parser()
     p.recurse_submodule = _get_setting(window, DP_SETTING_RESURSE_MODULES, False)
-    PARSERS[active_folder] = p
 
-    predefines = _get_configs_from_file(
+    predefines, include_flags = _get_configs_from_file(
         window, _get_setting(window, DP_SETTING_COMPILE_FILE)
     )
-    if predefines:
+    if predefines or include_flags:
         for d in predefines:
             logger.debug("  predefine: %s", d)
             p.insert_define(d[0], token=d[1])
+        for flag, path in include_flags:
+            logger.debug("  include path: %s %s", flag, path)
+            p.add_include_path(path, flag, active_folder)
     else:
         compile_flag_txt = Path(active_folder) / "compile_flags.txt"
         if compile_flag_txt.exists():
-            p.load_compile_flags(compile_flag_txt.read_text())
+            p.load_compile_flags(compile_flag_txt.read_text(), active_folder)
+
+    def publish(parser):
+        PARSERS[active_folder] = parser
+
+    _start_building(
+        window,
+        p,
+        active_folder,
+        active_folder,
+        publish,
+        _get_cache_file_for_folder(active_folder),
+        publish_partial=active_folder not in PARSERS,
+        previous=PARSERS.get(active_folder),
+        load_cache=True,
+    )
 
-    def async_proc():
-        p.read_folder_h(active_folder)
-        PARSER_IS_BUILDING.remove(active_folder)
+
+def _start_building(
+    window,
+    p,
+    folder,
+    building_key,
+    publish,
+    cache_file,
+    publish_partial,
+    previous=None,
+    load_cache=False,
+    shared_scan=False,
+):
+    """build `p` in a background thread, `publish(parser)` makes a parser visible to readers
+
+    readers keep using the previously published parser until the building is done, when
+    `publish_partial`, snapshots of the define tables built so far are published meanwhile.
+    `previous`: parser replaced by `p`, its values of the unchanged defines are reused.
+    `load_cache`: publish the parser of `cache_file` instead of building `p`, if it is valid.
+    `shared_scan`: read the header files and directive lines scanned once for `folder` by the
+    other shared scan buildings, these are queued to run one at a time.
+    Parsers are published with their lookups built, see `Parser.build_lookups()`.
+    """
+    last_publish_time = [time.perf_counter()]
+
+    def on_progress(done_count, total_count):
+        now = time.perf_counter()
+        if publish_partial and now - last_publish_time[0] > PARTIAL_SNAPSHOT_INTERVAL:
+            last_publish_time[0] = now
+            publish(p.snapshot())
+            sublime.status_message(
+                "building define database, %d/%d files..." % (done_count, total_count)
+            )
+
+    trace_memory = _get_setting(window, DP_SETTING_TRACE_MEMORY, False)
+
+    def build():
+        try:
+            cached = _load_parser_cache(cache_file) if load_cache else None
+            if cached is not None:
+                publish(cached.publish().build_lookups())
+            else:
+                header_files, scanned = _get_folder_scan(p, folder) if shared_scan else (None, None)
+                p.read_folder_h(folder, on_progress=on_progress, header_files=header_files, scanned=scanned)
+                publish(p.publish().build_lookups())
+        finally:
+            PARSER_IS_BUILDING.discard(building_key)
+        if cached is None and trace_memory and tracemalloc.is_tracing():
+            p.stats.record_memory("read_folder_h peak", tracemalloc.get_traced_memory()[1])
 
         if _get_setting(window, DP_SETTING_HL_INACTIVE):
             _mark_inactive_code(window.active_view())
+        if cached is not None:
+            logger.debug("cache file loaded from {!r}".format(cache_file))
+            return
 
         sublime.status_message("building define database done.")
-        logger.info("done_parser: %s", active_folder)
-        with p.pickable() as pp:
-            obj = pickle.dumps(pp)
-        cache_file = _get_cache_file_for_folder(active_folder)
-        with open(cache_file, "wb") as fs:
-            fs.write(obj)
-        logger.debug("cache file saved as {!r}".format(cache_file))
+        logger.info("done_parser: %s", cache_file)
+        p.build_value_table(previous)
+        _save_parser_cache(p, cache_file)
+        if trace_memory and tracemalloc.is_tracing():
+            _record_traced_memory(p.stats)
+
+    def traced_build():
+        # a trace started by someone else (ie: another building) is shared, and never stopped here
+        own_trace = not tracemalloc.is_tracing()
+        if own_trace:
+            tracemalloc.start()
+        try:
+            build()
+        finally:
+            if own_trace:
+                tracemalloc.stop()
 
+    PARSER_IS_BUILDING.add(building_key)
     sublime.status_message("building define database, please wait...")
-    sublime.set_timeout_async(async_proc, 0)
+    if shared_scan:
+        _queue_building(traced_build if trace_memory else build)
+    else:
+        threading.Thread(target=traced_build if trace_memory else build, daemon=True).start()
+
+
+def _queue_building(build):
+    """run `build()` after the queued buildings, in a single worker thread started on first use"""
+    global FLAG_SET_WORKER
+    FLAG_SET_BUILDS.put(build)
+    if FLAG_SET_WORKER is None:
+        FLAG_SET_WORKER = threading.Thread(target=_run_queued_buildings, daemon=True)
+        FLAG_SET_WORKER.start()
+
+
+def _run_queued_buildings():
+    while True:
+        build = FLAG_SET_BUILDS.get()
+        try:
+            build()
+        except Exception:
+            logger.exception("building define database failed")
+
+
+def _get_folder_scan(p, folder):
+    """(header files, scanned directive lines) of `folder`, shared by its flag set buildings
+
+    only used from the queued buildings, so never scanned by two threads together.
+    """
+    key = (folder, p.recurse_submodule)
+    scan = FLAG_SET_SCANS.get(key)
+    if scan is None:
+        with p.stats.timeit("discover_files"):
+            header_files = C_DefineParser.discover_header_files(folder, [".h"], p.recurse_submodule)
+        scan = FLAG_SET_SCANS[key] = (header_files, {})
+    return scan
+
+
+def _record_traced_memory(stats, top_n=10):
+    """record the steady traced memory after a building, and where it is allocated"""
+    snapshot = tracemalloc.take_snapshot()
+    stats.record_memory("steady", tracemalloc.get_traced_memory()[0])
+    stats.memory_sites = [
+        (stat.size, str(stat.traceback)) for stat in snapshot.statistics("lineno")[:top_n]
+    ]
+
+
+def _load_compile_commands(folder):
+    COMPILE_DBS.pop(folder, None)
+    for filename in COMPILE_COMMANDS_FILES:
+        json_file = os.path.join(folder, filename)
+        if not os.path.isfile(json_file):
+            continue
+        try:
+            COMPILE_DBS[folder] = C_DefineParser.CompilationDatabase.load(json_file)
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.warning("Fail to load {!r}. {}".format(json_file, e))
+            continue
+        logger.info("compilation database: %s", json_file)
+        return
+
+
+def _get_flag_set_parser(window, folder, flags, start_building=True):
+    """parser for one unique flag set of compile_commands.json
+
+    the folder parser is used until the first snapshot of the flag set is published.
+    `start_building`: load or build the flag set parser when there is none yet.
+    """
+    key = (folder, C_DefineParser.CompilationDatabase.flags_key(flags))
+    with FLAG_SET_LOCK:
+        parser = FLAG_SET_PARSERS.get(key)
+        if parser is not None:
+            FLAG_SET_PARSERS.move_to_end(key)
+            return parser
+    if key in PARSER_IS_BUILDING or not start_building:
+        return _get_parser(window)
+
+    cache_file = _get_cache_file_for_folder(*key)
+    p = C_DefineParser.Parser()
+    p.recurse_submodule = _get_setting(window, DP_SETTING_RESURSE_MODULES, False)
+    p.load_flag_set(flags)
+
+    def publish(parser):
+        _set_flag_set_parser(key, parser)
+
+    _start_building(
+        window, p, folder, key, publish, cache_file, publish_partial=True, load_cache=True, shared_scan=True
+    )
+    return _get_parser(window)
+
+
+def _set_flag_set_parser(key, parser):
+    """keep `parser` of flag set `key`, dropping the least recently used parsers over the bound"""
+    with FLAG_SET_LOCK:
+        FLAG_SET_PARSERS[key] = parser
+        FLAG_SET_PARSERS.move_to_end(key)
+        while len(FLAG_SET_PARSERS) > FLAG_SET_PARSERS_MAX:
+            FLAG_SET_PARSERS.popitem(last=False)
 
 
 def _get_parser(window):
@@ -190,11 +404,66 @@ def _get_parser(window):
     return PARSERS[active_folder]
 
 
+def _get_view_parser(view, start_building=True):
+    """parser of `view` with the temporary defines of the view, see `_parse_temp_define()`
+
+    `start_building`: see `_get_flag_set_parser()`, readers on the UI thread must not load
+    or build anything.
+    """
+    p = _get_view_base_parser(view, start_building)
+    overlay = VIEW_OVERLAYS.get(view.id())
+    if overlay is not None and overlay[0] is p:
+        return overlay[2]
+    return p
+
+
+def _get_view_base_parser(view, start_building=True):
+    """parser built with the compile flags of the file in `view`, or the folder parser"""
+    window = view.window()
+    folder = _get_folder(window)
+    filename = view.file_name()
+    db = COMPILE_DBS.get(folder)
+    if db is not None and filename and not _get_setting(window, DP_SETTING_COMPILE_FILE):
+        flags = db.flags_of(filename)
+        if flags is not None:
+            return _get_flag_set_parser(window, folder, flags, start_building)
+    return _get_parser(window)
+
+
+def _file_stamp(filepath):
+    """(mtime, size) of file `filepath`, None if it can not be read"""
+    try:
+        stat = os.stat(filepath)
+    except (OSError, TypeError):
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _get_view_result(view, parser, kind, compute):
+    """`compute()` result of `kind` for `view`, reused until the buffer, file, config or parser changes
+
+    The results are computed from the file on disk, which may change without the buffer, ie:
+    by a save or another program.
+    """
+    key = (
+        view.change_count(),
+        _file_stamp(view.file_name()),
+        _get_setting(view.window(), DP_SETTING_COMPILE_FILE),
+        id(parser),
+        parser.generation,
+    )
+    results = VIEW_RESULTS.setdefault(view.id(), {})
+    cached = results.get(kind)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    result = compute()
+    results[kind] = (key, result)
+    return result
+
+
 def _mark_inactive_code(view):
     window = view.window()
-    if _get_folder(window) in PARSER_IS_BUILDING:
-        return
-    p = _get_parser(window)
+    p = _get_view_parser(view)
     filename = view.file_name()
     if p is None or filename is None:
         return
@@ -208,28 +477,19 @@ def _mark_inactive_code(view):
         logger.debug("filetype not support: %r", ext)
         return
 
-    ctx_mgr = p.read_c if is_src else p.read_h
-
-    fileio = io.StringIO(view.substr(sublime.Region(0, view.size())))
-    fileio.name = filename
-    num_lines = len(fileio.readlines())
-    inactive_lines = set(range(1, 1 + num_lines))
-
-    fileio.seek(0)
-    with ctx_mgr(filename, try_if_else=True):
-        for _, lineno in p.read_file_lines(
-            fileio,
-            reserve_whitespace=True,
-            ignore_header_guard=True,
-        ):
-            inactive_lines.remove(lineno)
-    inactive_lines -= set(p.filelines.get(filename, []))
-    logger.debug("inactive lines count: %d", len(inactive_lines))
-
-    regions = [
-        sublime.Region(view.text_point(line - 1, 0), view.text_point(line, 0))
-        for line in inactive_lines
-    ]
+    def inactive_regions():
+        text = view.substr(sublime.Region(0, view.size()))
+        num_lines = len(io.StringIO(text).readlines())
+        inactive_lines = set(range(1, 1 + num_lines))
+        inactive_lines.difference_update(p.active_lines(filename, text, is_src))
+        inactive_lines.difference_update(p.get_directive_lines(filename))
+        logger.debug("inactive lines count: %d", len(inactive_lines))
+        return [
+            sublime.Region(view.text_point(line - 1, 0), view.text_point(line, 0))
+            for line in inactive_lines
+        ]
+
+    regions = _get_view_result(view, p, "inactive_regions", inactive_regions)
     view.add_regions(
         REGION_INACTIVE_NAME,
         regions,
@@ -244,42 +504,46 @@ def _unmark_inactive_code(view):
 
 
 def _parse_temp_define(view):
+    """keep the defines of the `view` buffer in an overlay of the shared parser"""
     window = view.window()
-    if _get_folder(window) in PARSER_IS_BUILDING:
-        return
-    p = _get_parser(window)
+    p = _get_view_base_parser(view)
     filename = view.file_name()
     _, ext = os.path.splitext(filename)
     if p is None or filename is None or ext == ".h":
         return
-    fileio = io.StringIO(view.substr(sublime.Region(0, view.size())))
-    fileio.name = filename
-    for line, lineno in p.read_file_lines(
-        fileio,
-        ignore_header_guard=True,
-    ):
-        define = p._do_define_directive(line)
-        if define is None:
-            continue
-        p.insert_temp_define(
+
+    def local_defines():
+        fileio = io.StringIO(view.substr(sublime.Region(0, view.size())))
+        fileio.name = filename
+        scope = p.scoped()
+        defines = []
+        for line, lineno in scope.read_file_lines(
+            fileio,
+            ignore_header_guard=True,
+        ):
+            define = scope._do_define_directive(line)
+            if define is not None:
+                defines.append((define, lineno))
+        return defines
+
+    temp_defines = _get_view_result(view, p, "temp_defines", local_defines)
+    overlay = VIEW_OVERLAYS.get(view.id())
+    if overlay is not None and overlay[0] is p and overlay[1] is temp_defines:
+        return
+    view_parser = p.overlay()
+    for define, lineno in temp_defines:
+        view_parser.insert_temp_define(
             name=define.name,
             params=define.params,
             token=define.token,
             filename=filename,
             lineno=lineno,
         )
+    VIEW_OVERLAYS[view.id()] = (p, temp_defines, view_parser)
 
 
 def _remove_temp_define(view):
-    window = view.window()
-    if _get_folder(window) in PARSER_IS_BUILDING:
-        return
-    p = _get_parser(window)
-    filename = view.file_name()
-    _, ext = os.path.splitext(filename)
-    if p is None or filename is None or ext == ".h":
-        return
-    p.remove_temp_define(filename)
+    VIEW_OVERLAYS.pop(view.id(), None)
 
 
 def _get_config_list(window):
@@ -294,17 +558,22 @@ def _get_config_list(window):
         return []
 
 
-def _get_configs_from_file(window, file_basename):
+def _get_configs_from_file(window, config_file):
+    """return (list of (name, value) from -D, list of (flag, path) from -I/-iquote/-isystem)
+
+    `config_file`: path of the config file, or its path relative to the config folder
+    """
     folder = _get_folder(window)
-    if folder is None or file_basename is None:
-        return []
-    select_config = os.path.join(folder, PREDEFINE_FOLDER, file_basename)
+    if folder is None or config_file is None:
+        return [], []
+    select_config = os.path.join(folder, PREDEFINE_FOLDER, config_file)
     if not os.path.isfile(select_config) or not os.path.exists(select_config):
-        return []
+        return [], []
 
     insert_defs = []
     with open(select_config) as fs:
-        compile_flags = " ".join(fs.readlines()).split(" ")
+        compile_flags = [flag.strip() for flag in " ".join(fs.readlines()).split(" ")]
+        include_flags = list(C_DefineParser.iter_include_flags(compile_flags))
         for flag in compile_flags:
             flag = flag.strip()
             if flag.startswith("-D"):
@@ -319,7 +588,90 @@ def _get_configs_from_file(window, file_basename):
                     continue
                 insert_defs.append((insert_defname, insert_value))
 
-    return insert_defs
+    return insert_defs, include_flags
+
+
+def _get_config_parsers(window, folder):
+    """dict[config, Parser] of all the configurations, building the missing ones
+
+    `config`: path of the config file relative to the config folder, as config files of
+    subfolders may share a name
+    """
+    parsers = {}
+    missing_flag_sets = {}
+    config_folder = os.path.join(folder, PREDEFINE_FOLDER)
+    for config_file in _get_config_list(window):
+        config = os.path.relpath(config_file, config_folder)
+        flags = C_DefineParser.CompileFlags(*_get_configs_from_file(window, config_file))
+        key = (folder, C_DefineParser.CompilationDatabase.flags_key(flags))
+        parser = FLAG_SET_PARSERS.get(key) or _load_parser_cache(_get_cache_file_for_folder(*key))
+        if parser is None or parser.partial:
+            missing_flag_sets[config] = flags
+        else:
+            _set_flag_set_parser(key, parser)
+            parsers[config] = parser
+
+    if missing_flag_sets:
+        sublime.status_message("building %d configurations..." % len(missing_flag_sets))
+        built = C_DefineParser.build_parsers(
+            folder,
+            missing_flag_sets,
+            _get_setting(window, DP_SETTING_RESURSE_MODULES, False),
+        )
+        for config, parser in built.items():
+            key = (folder, C_DefineParser.CompilationDatabase.flags_key(missing_flag_sets[config]))
+            _set_flag_set_parser(key, parser)
+            _save_parser_cache(parser, _get_cache_file_for_folder(*key))
+        parsers.update(built)
+    return parsers
+
+
+class CompareConfigurationsCommand(sublime_plugin.TextCommand):
+    """value of the symbol under cursor, or the active state of the cursor line, in every configuration"""
+
+    def run(self, edit, mode="value"):
+        view = self.view
+        window = view.window()
+        folder = _get_folder(window)
+        filename = view.file_name()
+        if folder is None or filename is None:
+            return
+        if not _get_config_list(window):
+            _alert_no_config(window)
+            return
+
+        point = view.sel()[0].begin()
+        symbol = view.substr(view.word(point))
+        line = view.rowcol(point)[0] + 1
+        text = view.substr(sublime.Region(0, view.size()))
+        _, ext = os.path.splitext(filename)
+        is_src = ext in _get_setting(window, DP_SETTING_SUPPORT_SOURCE_EXTS)
+
+        def compare():
+            parsers = _get_config_parsers(window, folder)
+            rows = []
+            for config, parser in sorted(parsers.items()):
+                if mode == "active":
+                    active_lines = parser.active_lines(filename, text, is_src)
+                    state = "active" if line in active_lines else "inactive"
+                    rows.append("%-40s %-10s (%d active lines)" % (config, state, len(active_lines)))
+                else:
+                    result = parser.evaluate_many([symbol])[0]
+                    if result.value is not None:
+                        rows.append("%-40s %s (%s)" % (config, result.value, hex(result.value)))
+                    else:
+                        rows.append("%-40s %s" % (config, result.expanded))
+
+            if mode == "active":
+                title = "%s:%d" % (os.path.basename(filename), line)
+            else:
+                title = symbol
+            new_view = window.new_file(sublime.TRANSIENT)
+            new_view.set_name("Configurations - " + title)
+            new_view.set_scratch(True)
+            new_view.run_command("append_define", {"text": title + "\n\n" + "\n".join(rows) + "\n"})
+
+        sublime.set_timeout_async(compare, 0)
 
 
 class RebuildDefineDatabaseCommand(sublime_plugin.WindowCommand):
@@ -331,6 +683,17 @@ class RebuildDefineDatabaseCommand(sublime_plugin.WindowCommand):
         cache_file = _get_cache_file_for_folder(active_folder)
         if os.path.exists(cache_file):
             os.remove(cache_file)
+
+        # parsers of compile_commands.json flag sets are rebuilt on next use
+        with FLAG_SET_LOCK:
+            for key in [k for k in FLAG_SET_PARSERS if k[0] == active_folder]:
+                del FLAG_SET_PARSERS[key]
+        for key in [k for k in FLAG_SET_SCANS if k[0] == active_folder]:
+            del FLAG_SET_SCANS[key]
+        flag_set_prefix = _escape_filepath(active_folder) + "@"
+        for tag_file in os.listdir(CACHE_OBJ_FOLDER):
+            if tag_file.startswith(flag_set_prefix):
+                os.remove(os.path.join(CACHE_OBJ_FOLDER, tag_file))
         _init_parser(self.window)
 
 
@@ -466,34 +829,326 @@ class AppendDefine(sublime_plugin.TextCommand):
         self.view.insert(edit, self.view.size(), text)
 
 
+DefineRow = namedtuple("DefineRow", ["name", "value", "file", "lineno", "line"])
+
+
+def _get_define_rows(parser):
+    """formatted rows of all defines, cached until the parser or its value table changes"""
+    key = (parser.generation, len(parser.values))
+    rows = DEFINE_ROWS_CACHE.get(key)
+    if rows is not None:
+        return rows
+
+    rows = []
+    for define in list(parser.defs.values()):
+        value = parser.values.get(define.name)
+        if value is None:
+            value = parser.cdef.try_eval_num(define.token)
+        if value is not None:
+            line = "#define %-30s (0x%x)" % (define.name, value)
+        else:
+            line = "#define %-30s (%s)" % (define.name, define.token)
+        rows.append(DefineRow(define.name, value, parser.files.path(define.file), define.lineno, line))
+
+    DEFINE_ROWS_CACHE.clear()  # only keep rows of the latest listed parser
+    DEFINE_ROWS_CACHE[key] = rows
+    return rows
+
+
+def _filter_define_rows(rows, name_prefix="", file_pattern="", value=None, sort_by=""):
+    if name_prefix:
+        rows = [r for r in rows if r.name.startswith(name_prefix)]
+    if file_pattern:
+        rows = [r for r in rows if file_pattern in r.file]
+    if value is not None:
+        rows = [r for r in rows if r.value == value]
+    if sort_by == "name":
+        rows = sorted(rows, key=lambda r: r.name)
+    elif sort_by == "file":
+        rows = sorted(rows, key=lambda r: (r.file, r.lineno))
+    elif sort_by == "value":
+        # non-numeric values go last
+        rows = sorted(rows, key=lambda r: (r.value is None, r.value or 0, r.name))
+    return rows
+
+
 class ShowAllDefinesCommand(sublime_plugin.WindowCommand):
-    def run(self):
+    def run(self, name_prefix="", file_pattern="", value=None, sort_by="", ask_prefix=False):
         folder = _get_folder(self.window)
         parser = _get_parser(self.window)
         if folder is None or parser is None:
             return
-        if folder in PARSER_IS_BUILDING:
-            sublime.error_message("Parsing defines in progress, please wait...")
+        if ask_prefix:
+            self.window.show_input_panel(
+                "#define name prefix:",
+                name_prefix,
+                lambda prefix: self.run(prefix, file_pattern, value, sort_by),
+                None,
+                None,
+            )
             return
+        if parser.partial:
+            sublime.status_message("define database is still building, the list may be incomplete.")
         if len(parser.defs) == 0:
             sublime.error_message("No #define found in " + folder)
             return
         new_view = self.window.new_file(sublime.TRANSIENT)
         new_view.set_name("Define Value - " + folder)
         new_view.set_syntax_file("Packages/C++/C.sublime-syntax")
+        new_view.set_scratch(True)
 
         def insert_defs():
-            for define in parser.defs.values():
-                token = define.token
-                token_value = parser.cdef.try_eval_num(token)
-                if token_value is not None:
-                    line = "#define %-30s (0x%x)" % (define.name, token_value)
+            rows = _get_define_rows(parser)
+            rows = _filter_define_rows(rows, name_prefix, file_pattern, value, sort_by)
+            for start in range(0, len(rows), DEFINE_LIST_CHUNK_SIZE):
+                chunk = rows[start : start + DEFINE_LIST_CHUNK_SIZE]
+                text = "\n".join(r.line for r in chunk) + "\n"
+                new_view.run_command("append_define", {"text": text})
+                sublime.status_message("listing defines... %d/%d" % (start + len(chunk), len(rows)))
+            sublime.status_message("%d defines found!" % len(rows))
+
+        threading.Thread(target=insert_defs, daemon=True).start()
+
+
+class ShowPreprocessedSourceCommand(sublime_plugin.TextCommand):
+    """active code of the file with macros expanded, in a new view"""
+
+    def run(self, edit):
+        view = self.view
+        window = view.window()
+        filename = view.file_name()
+        parser = _get_view_parser(view)
+        if parser is None or filename is None:
+            return
+        text = view.substr(sublime.Region(0, view.size())) if view.is_dirty() else None
+
+        new_view = window.new_file()
+        new_view.set_name("Preprocessed - " + os.path.basename(filename))
+        new_view.set_syntax_file("Packages/C++/C.sublime-syntax")
+        new_view.set_scratch(True)
+        source_lines = array("I")
+        PREPROCESSED_VIEWS[new_view.id()] = (filename, source_lines)
+
+        def insert_lines():
+            chunk = []
+            for lineno, line in parser.iter_preprocess_source(filename, text):
+                chunk.append(line)
+                source_lines.append(lineno)
+                if len(chunk) >= DEFINE_LIST_CHUNK_SIZE:
+                    new_view.run_command("append_define", {"text": "\n".join(chunk) + "\n"})
+                    sublime.status_message("preprocessing... %d lines" % len(source_lines))
+                    chunk = []
+            new_view.run_command("append_define", {"text": "\n".join(chunk)})
+            sublime.status_message("preprocessing done, %d lines" % len(source_lines))
+
+        threading.Thread(target=insert_lines, daemon=True).start()
+
+
+class GotoPreprocessedSourceCommand(sublime_plugin.TextCommand):
+    """jump from a line of the preprocessed view to the source line it comes from"""
+
+    def run(self, edit):
+        filename, source_lines = PREPROCESSED_VIEWS[self.view.id()]
+        row = self.view.rowcol(self.view.sel()[0].begin())[0]
+        if row < len(source_lines):
+            self.view.window().open_file(
+                "%s:%d" % (filename, source_lines[row]), sublime.ENCODED_POSITION
+            )
+
+    def is_enabled(self):
+        return self.view.id() in PREPROCESSED_VIEWS
+
+
+class ExportDefinesCommand(sublime_plugin.WindowCommand):
+    """write all defines with their values to a SQLite database or a JSON Lines file"""
+
+    def run(self, fmt="sqlite", path=""):
+        folder = _get_folder(self.window)
+        parser = _get_parser(self.window)
+        if folder is None or parser is None:
+            return
+        if not path:
+            default_path = os.path.join(folder, "defines.db" if fmt == "sqlite" else "defines.jsonl")
+            self.window.show_input_panel(
+                "Export defines to:",
+                default_path,
+                lambda path: self.run(fmt, path),
+                None,
+                None,
+            )
+            return
+        if parser.partial:
+            sublime.status_message("define database is still building, the export may be incomplete.")
+        config = _get_setting(self.window, DP_SETTING_COMPILE_FILE) or ""
+
+        def export():
+            records = parser.iter_define_records(config)
+            try:
+                if fmt == "sqlite":
+                    count = export_sqlite(records, path, config)
                 else:
-                    line = "#define %-30s (%s)" % (define.name, token)
-                new_view.run_command("append_define", {"text": line + "\n"})
-            sublime.status_message("%d defines found!" % len(parser.defs))
+                    with open(path, "w", encoding="utf-8") as fs:
+                        count = export_jsonl(records, fs)
+            except Exception as e:
+                sublime.error_message("Fail to export defines to {!r}. {}".format(path, e))
+                return
+            sublime.status_message("%d defines exported to %s" % (count, path))
+
+        sublime.set_timeout_async(export, 0)
+
+
+class ShowMemoryUsageCommand(sublime_plugin.WindowCommand):
+    """approximate memory of each part of the define data, and the traced memory of the building"""
+
+    def run(self):
+        folder = _get_folder(self.window)
+        parser = _get_parser(self.window)
+        if folder is None or parser is None:
+            return
+
+        def report():
+            usage = parser.memory_usage()
+            lines = ["# Memory usage (approximate)", ""]
+            for name, nbytes in sorted(usage.items(), key=lambda x: -x[1]):
+                lines.append("%-36s %12s" % (name, format_bytes(nbytes)))
+            lines.append("%-36s %12s" % ("total", format_bytes(sum(usage.values()))))
+            cache_info = C_DefineParser.compile_c_expr.cache_info()
+            lines.append("%-36s %12d" % ("compiled expressions cached", cache_info.currsize))
+            if parser.stats.memory:
+                lines += ["", "# Traced memory of the last building", ""]
+                for name, nbytes in parser.stats.memory.items():
+                    lines.append("%-36s %12s" % (name, format_bytes(nbytes)))
+                lines.append("")
+                for nbytes, site in parser.stats.memory_sites:
+                    lines.append("%12s  %s" % (format_bytes(nbytes), site))
+            else:
+                lines += ["", "Enable \"%s\" and rebuild to trace the memory of building." % DP_SETTING_TRACE_MEMORY]
+
+            new_view = self.window.new_file(sublime.TRANSIENT)
+            new_view.set_name("Memory Usage - " + folder)
+            new_view.set_syntax_file("Packages/Markdown/Markdown.sublime-syntax")
+            new_view.run_command("append_define", {"text": "\n".join(lines) + "\n"})
+            new_view.set_scratch(True)
+
+        sublime.status_message("measuring memory usage...")
+        sublime.set_timeout_async(report, 0)
+
+
+class CompareWithPreprocessorCommand(sublime_plugin.TextCommand):
+    """check the macro values and active lines of the file against the C preprocessor"""
+
+    def run(self, edit):
+        view = self.view
+        window = view.window()
+        folder = _get_folder(window)
+        filename = view.file_name()
+        parser = _get_view_parser(view)
+        if folder is None or filename is None or parser is None:
+            return
+
+        db = COMPILE_DBS.get(folder)
+        config = _get_setting(window, DP_SETTING_COMPILE_FILE)
+        flags = db.flags_of(filename) if db is not None and not config else None
+        if flags is not None:
+            args = flags_to_args(flags.defines, flags.include_flags)
+        else:
+            defines, include_flags = _get_configs_from_file(window, config)
+            include_flags = [(flag, os.path.join(folder, path)) for flag, path in include_flags]
+            args = flags_to_args(defines, include_flags)
+        _, ext = os.path.splitext(filename)
+        is_src = ext in _get_setting(window, DP_SETTING_SUPPORT_SOURCE_EXTS)
+        cpp = _get_setting(window, DP_SETTING_CPP_COMMAND, "cpp")
+
+        def compare():
+            try:
+                report = compare_with_cpp(parser, filename, args, cpp, is_src)
+            except (OSError, subprocess.CalledProcessError) as e:
+                sublime.error_message(
+                    "Fail to run the C preprocessor {!r}. {}\n{}".format(cpp, e, getattr(e, "stderr", "") or "")
+                )
+                return
+            new_view = window.new_file(sublime.TRANSIENT)
+            new_view.set_name("Preprocessor Check - " + os.path.basename(filename))
+            new_view.set_syntax_file("Packages/Markdown/Markdown.sublime-syntax")
+            new_view.run_command("append_define", {"text": format_compare_report(report)})
+            new_view.set_scratch(True)
+
+        sublime.status_message("comparing with the C preprocessor...")
+        sublime.set_timeout_async(compare, 0)
+
+
+class ShowBuildStatisticsCommand(sublime_plugin.WindowCommand):
+    def run(self, fmt="text"):
+        folder = _get_folder(self.window)
+        parser = _get_parser(self.window)
+        if folder is None or parser is None:
+            return
+        if fmt == "json":
+            text = parser.stats.to_json()
+            syntax = "Packages/JavaScript/JSON.sublime-syntax"
+        else:
+            text = parser.stats.format_report()
+            syntax = "Packages/Markdown/Markdown.sublime-syntax"
+        new_view = self.window.new_file(sublime.TRANSIENT)
+        new_view.set_name("Build Statistics - " + folder)
+        new_view.set_syntax_file(syntax)
+        new_view.run_command("append_define", {"text": text})
+        new_view.set_scratch(True)
 
-        sublime.set_timeout_async(insert_defs, 0)
+
+TRUNCATED_NOTE = "<br><em>(expansion truncated, too deep or too long)</em>"
+
+
+def _show_expansion_popup(view, parser, symbol, location=-1):
+    """evaluate `symbol` in the context of the file in `view`, and show it in a popup"""
+    window = view.window()
+    filename = view.file_name()
+    _, ext = os.path.splitext(filename)
+    is_src = filename and ext in _get_setting(window, DP_SETTING_SUPPORT_SOURCE_EXTS)
+    ctx_mgr = parser.read_c if is_src else parser.read_h
+
+    with ctx_mgr(filename, try_if_else=True) as scope:
+        define = scope.get_expand_define(symbol)
+        if define is not None:
+            logger.debug("%r", define)
+            value = scope.cdef.try_eval_num(define.token)
+            if value is not None:
+                text = "{} ({})".format(value, hex(value))
+            else:
+                text = html.escape(convertall_dec2fmt(define.token))
+            if getattr(define.token, "truncated", False):
+                text += TRUNCATED_NOTE
+
+            logger.info("%s = %s", define.name, text)
+            view.show_popup(
+                "<em>Expansion of</em> <small>{}{}</small><br>{}".format(
+                    define.name,
+                    "(%s)" % (", ".join(define.params))
+                    if define.params is not None
+                    else "",
+                    text,
+                ),
+                location=location,
+                max_width=800,
+            )
+        else:
+            expanded_token = scope.expand_token(symbol)
+            logger.debug("%r", expanded_token)
+            value = scope.cdef.try_eval_num(expanded_token)
+            if value is not None:
+                text = "{} ({})".format(value, hex(value))
+            else:
+                text = convertall_dec2fmt(expanded_token, "0x{:02x}")
+            logger.info("%s = %s", symbol, text)
+            view.show_popup(
+                "<em>Expansion of</em> <small>{}</small><br>{}{}".format(
+                    html.escape(symbol),
+                    html.escape(text),
+                    TRUNCATED_NOTE if getattr(expanded_token, "truncated", False) else "",
+                ),
+                location=location,
+                max_width=800,
+            )
 
 
 class CalculateDefineValue(sublime_plugin.TextCommand):
@@ -501,9 +1156,10 @@ class CalculateDefineValue(sublime_plugin.TextCommand):
         window = sublime.active_window()
         view = window.active_view()
 
-        parser = _get_parser(window)
+        parser = _get_view_parser(view)
         if parser is None:
-            _init_parser(window)
+            if _get_parser(window) is None:
+                _init_parser(window)
             return
 
         region = view.sel()[0]
@@ -518,48 +1174,67 @@ class CalculateDefineValue(sublime_plugin.TextCommand):
                 region = sublime.Region(region.begin(), region.end() + 1)
         symbol = view.substr(region)
 
-        filename = view.file_name()
-        _, ext = os.path.splitext(filename)
-        is_src = filename and ext in _get_setting(window, DP_SETTING_SUPPORT_SOURCE_EXTS)
-        ctx_mgr = parser.read_c if is_src else parser.read_h
+        _show_expansion_popup(view, parser, symbol)
 
-        with ctx_mgr(filename, try_if_else=True):
-            define = parser.get_expand_define(symbol)
-            if define is not None:
-                logger.debug("%r", define)
-                value = parser.cdef.try_eval_num(define.token)
-                if value is not None:
-                    text = "{} ({})".format(value, hex(value))
-                else:
-                    text = html.escape(convertall_dec2fmt(define.token))
-
-                logger.info("%s = %s", define.name, text)
-                view.show_popup(
-                    "<em>Expansion of</em> <small>{}{}</small><br>{}".format(
-                        define.name,
-                        "(%s)" % (", ".join(define.params))
-                        if define.params is not None
-                        else "",
-                        text,
-                    ),
-                    max_width=800,
-                )
-            else:
-                expanded_token = parser.expand_token(symbol)
-                logger.debug("%r", expanded_token)
-                value = parser.cdef.try_eval_num(expanded_token)
-                if value is not None:
-                    text = "{} ({})".format(value, hex(value))
-                else:
-                    text = convertall_dec2fmt(expanded_token, "0x{:02x}")
-                logger.info("%s = %s", symbol, text)
-                view.show_popup(
-                    "<em>Expansion of</em> <small>{}</small><br>{}".format(
-                        html.escape(symbol),
-                        html.escape(text),
-                    ),
-                    max_width=800,
-                )
+
+def _get_symbol_under_cursor(window):
+    view = window.active_view()
+    if view is None or len(view.sel()) == 0:
+        return ""
+    return view.substr(view.word(view.sel()[0]))
+
+
+def _define_location(parser, define):
+    """'file:line' of `define`, None for the ones not from a file, ie: -D predefines"""
+    if not define.file:
+        return None
+    return "%s:%d" % (parser.files.path(define.file), define.lineno)
+
+
+def _show_defines_panel(window, parser, defines, selected_index=0):
+    """quick panel of `defines` (sorted by name), jumps to the selected definition"""
+    items = [[define.name, _define_location(parser, define) or "(predefined)"] for define in defines]
+
+    def on_select(index):
+        if index < 0:
+            return
+        location = _define_location(parser, defines[index])
+        if location is None:
+            sublime.status_message("%s is predefined, not defined in a file" % defines[index].name)
+            return
+        window.open_file(location, sublime.ENCODED_POSITION)
+
+    window.show_quick_panel(items, on_select, selected_index=selected_index)
+
+
+class GotoDefineCommand(sublime_plugin.WindowCommand):
+    def run(self, name_prefix=""):
+        parser = _get_parser(self.window)
+        if parser is None:
+            return
+        defines = parser.find_defines(name_prefix)
+        if not defines:
+            sublime.status_message("No #define found with prefix %r" % name_prefix)
+            return
+
+        names = [define.name for define in defines]
+        selected_index = bisect_left(names, _get_symbol_under_cursor(self.window))
+        _show_defines_panel(self.window, parser, defines, min(selected_index, len(defines) - 1))
+
+
+class ShowDefineDependentsCommand(sublime_plugin.WindowCommand):
+    def run(self, name=""):
+        parser = _get_parser(self.window)
+        if parser is None:
+            return
+        name = name or _get_symbol_under_cursor(self.window)
+        dependents = parser.dependency_graph().dependents([name])
+        if not dependents:
+            sublime.status_message("No #define depends on %r" % name)
+            return
+        defines = [parser.defs[n] for n in sorted(dependents) if n in parser.defs]
+        sublime.status_message("%d defines depend on %r" % (len(defines), name))
+        _show_defines_panel(self.window, parser, defines)
 
 
 class ToggleDefineParserDebugLog(sublime_plugin.WindowCommand):
@@ -592,6 +1267,8 @@ class EvtListener(sublime_plugin.EventListener):
         filename = view.file_name()
         logger.debug("save %s", filename)
         window = view.window()
+        # the file may keep its mtime and size, ie: on file systems of coarse mtime
+        VIEW_RESULTS.pop(view.id(), None)
 
         current_config = _get_setting(window, DP_SETTING_COMPILE_FILE)
         if filename == current_config:
@@ -618,6 +1295,62 @@ class EvtListener(sublime_plugin.EventListener):
         else:
             _unmark_inactive_code(view)
 
+    def on_hover(self, view, point, hover_zone):
+        window = view.window()
+        filename = view.file_name()
+        if hover_zone != sublime.HOVER_TEXT or window is None or filename is None:
+            return
+        if not _get_setting(window, DP_SETTING_HOVER_VALUE):
+            return
+        # on the UI thread: nothing is shown until a parser is published with its lookups
+        parser = _get_view_parser(view, start_building=False)
+        if parser is None or not parser.has_lookups():
+            return
+
+        symbol = view.substr(view.word(point))
+        value = parser.get_cached_value(symbol, filename)
+        if value is not None:
+            view.show_popup(
+                "<em>Value of</em> <small>{}</small><br>{} ({})".format(
+                    html.escape(symbol), value, hex(value)
+                ),
+                flags=sublime.HIDE_ON_MOUSE_MOVE_AWAY,
+                location=point,
+                max_width=800,
+            )
+        elif parser.is_defined(symbol, filename):
+            # function-like, not numeric or depends on the file context
+            sublime.set_timeout_async(
+                lambda: _show_expansion_popup(view, parser, symbol, point), 0
+            )
+
+    def on_query_completions(self, view, prefix, locations):
+        window = view.window()
+        if window is None or len(prefix) < 2 or not _get_setting(window, DP_SETTING_COMPLETION):
+            return None
+        if not view.match_selector(locations[0], "source.c, source.c++"):
+            return None
+        parser = _get_view_parser(view, start_building=False)
+        if parser is None or not parser.has_lookups():
+            return None
+
+        completions = []
+        for define in parser.find_defines(prefix, COMPLETION_LIMIT):
+            value = parser.values.get(define.name)
+            if value is not None:
+                hint = hex(value)
+            elif define.params is not None:
+                hint = "(%s)" % ", ".join(define.params)
+            else:
+                hint = "#define"
+            completions.append(["%s\t%s" % (define.name, hint), define.name])
+        return completions
+
+    def on_close(self, view):
+        PREPROCESSED_VIEWS.pop(view.id(), None)
+        VIEW_RESULTS.pop(view.id(), None)
+        VIEW_OVERLAYS.pop(view.id(), None)
+
     def on_deactivated_async(self, view):
         window = view.window()
         filename = view.file_name()
@@ -0,0 +1,11 @@
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the plugin is a package named after its folder in Sublime's Packages, with relative imports
+if "DefineParser" not in sys.modules:
+    package = types.ModuleType("DefineParser")
+    package.__path__ = [ROOT]
+    sys.modules["DefineParser"] = package
@@ -0,0 +1,195 @@
+"""differential check of the parser against the C preprocessor
+
+Synthetic trees are generated from fixed seeds. Real trees are checked too when
+DEFINE_PARSER_CPP_TREES lists their folders (separated by os.pathsep), ie:
+
+    DEFINE_PARSER_CPP_TREES=/path/to/project python -m pytest tests/test_cpp_check.py
+"""
+import os
+import random
+import shutil
+
+import pytest
+
+from DefineParser.C_DefineParser import Parser, glob_recursive
+from DefineParser.utils.cpp_check import compare_with_cpp, format_compare_report
+
+CPP = os.environ.get("DEFINE_PARSER_CPP", "cpp")
+SEEDS = range(20)
+REAL_TREES = [path for path in os.environ.get("DEFINE_PARSER_CPP_TREES", "").split(os.pathsep) if path]
+
+pytestmark = pytest.mark.skipif(shutil.which(CPP) is None, reason="C preprocessor %r not found" % CPP)
+
+
+class TreeGenerator:
+    """random headers and a source file using the macro features the parser supports
+
+    Left out on purpose: `#ifndef` at the top level of a file, taken as a header guard.
+    """
+
+    def __init__(self, seed):
+        self.rnd = random.Random(seed)
+        self.names = []  # object-like macros defined so far
+        self.functions = []  # (name, param count) of function-like macros
+        self.count = 0
+        self.code_count = 0
+
+    def new_name(self, prefix):
+        self.count += 1
+        return "%s_%d" % (prefix, self.count)
+
+    def literal(self):
+        value = self.rnd.randrange(64)
+        return self.rnd.choice(["%d", "0x%X", "%dU", "0x%xUL", "%dL"]) % value
+
+    def operand(self):
+        if self.names and self.rnd.random() < 0.6:
+            return self.rnd.choice(self.names)
+        if self.functions and self.rnd.random() < 0.3:
+            name, param_count = self.rnd.choice(self.functions)
+            return "%s(%s)" % (name, ", ".join(self.operand() for _ in range(param_count)))
+        return self.literal()
+
+    def value_expr(self, depth=2):
+        """non-negative expression of the operators having the same result in C and Python"""
+        if depth == 0 or self.rnd.random() < 0.3:
+            return self.operand()
+        op = self.rnd.choice(["+", "*", "&", "|", "^", "<<", ">>", "%", "/", "==", "<", ">=", "!="])
+        left = self.value_expr(depth - 1)
+        if op in ("<<", ">>"):
+            right = str(self.rnd.randrange(5))
+        elif op in ("%", "/"):
+            right = str(self.rnd.randrange(1, 9))
+        else:
+            right = self.value_expr(depth - 1)
+        return "((%s) %s (%s))" % (left, op, right)
+
+    def condition(self, depth=2):
+        if depth == 0 or self.rnd.random() < 0.3:
+            kind = self.rnd.random()
+            if kind < 0.3 and self.names:
+                return self.rnd.choice(["defined(%s)", "defined %s", "!defined(%s)"]) % self.rnd.choice(
+                    self.names + ["NOT_DEFINED"]
+                )
+            return "(%s) %s %d" % (self.value_expr(1), self.rnd.choice(["==", "!=", "<", ">"]), self.rnd.randrange(64))
+        op = self.rnd.choice(["&&", "||"])
+        return "(%s) %s (%s)" % (self.condition(depth - 1), op, self.condition(depth - 1))
+
+    def defines(self, lines, count, top_level=True):
+        """function-like macros are only defined at top level, as calling an undefined one is an error"""
+        for _ in range(count):
+            kind = self.rnd.random()
+            if kind < 0.1 and self.names:
+                lines.append("#undef %s" % self.names.pop(self.rnd.randrange(len(self.names))))
+            elif kind < 0.2 and top_level:
+                name = self.new_name("FN")
+                params = ["a", "b"][: self.rnd.randrange(1, 3)]
+                body = " + ".join("((%s) * %d)" % (p, self.rnd.randrange(1, 4)) for p in params)
+                lines.append("#define %s(%s) ((%s) %% 1000)" % (name, ", ".join(params), body))
+                self.functions.append((name, len(params)))
+            else:
+                name = self.new_name("MACRO")
+                lines.append("#define %s ((%s) %% 1000)" % (name, self.value_expr()))
+                self.names.append(name)
+
+    def conditional(self, lines, body, depth=2, nested=True):
+        """#if/#ifdef chain around `body(lines)` calls
+
+        `nested`: False at the top level of a file, where #ifndef is taken as a header guard.
+        """
+        kind = self.rnd.random()
+        if kind < 0.2 and self.names:
+            lines.append("#ifdef %s" % self.rnd.choice(self.names + ["NOT_DEFINED"]))
+        elif kind < 0.3 and self.names and nested:
+            lines.append("#ifndef %s" % self.rnd.choice(self.names + ["NOT_DEFINED"]))
+        else:
+            lines.append("#if %s" % self.condition())
+        self.block(lines, body, depth)
+        for _ in range(self.rnd.randrange(3)):
+            lines.append("#elif %s" % self.condition())
+            self.block(lines, body, depth)
+        if self.rnd.random() < 0.5:
+            lines.append("#else")
+            self.block(lines, body, depth)
+        lines.append("#endif")
+
+    def block(self, lines, body, depth):
+        body(lines)
+        if depth > 0 and self.rnd.random() < 0.4:
+            self.conditional(lines, body, depth - 1)
+            body(lines)
+
+    def code(self, lines):
+        for _ in range(self.rnd.randrange(1, 3)):
+            self.code_count += 1
+            lines.append("int code_%d = %d;" % (self.code_count, self.code_count))
+
+    def write_tree(self, root, header_count=3):
+        """write headers `inc/h<N>.h` each including the previous one, and `src/main.c`"""
+        inc = os.path.join(root, "inc")
+        src = os.path.join(root, "src")
+        os.makedirs(inc)
+        os.makedirs(src)
+        for index in range(header_count):
+            guard = "H%d_H" % index
+            lines = ["#ifndef %s" % guard, "#define %s" % guard]
+            if index:
+                lines.append('#include "h%d.h"' % (index - 1))
+            self.defines(lines, 8)
+            for _ in range(3):
+                self.conditional(lines, lambda lines: self.defines(lines, 2, top_level=False))
+            lines.append("#endif")
+            with open(os.path.join(inc, "h%d.h" % index), "w") as fs:
+                fs.write("\n".join(lines) + "\n")
+
+        lines = ['#include "h%d.h"' % (header_count - 1)]
+        self.defines(lines, 4)
+        for _ in range(6):
+            self.code(lines)
+            self.conditional(lines, self.code, nested=False)
+        with open(os.path.join(src, "main.c"), "w") as fs:
+            fs.write("\n".join(lines) + "\n")
+        return os.path.join(src, "main.c"), ["-I", inc]
+
+
+def _assert_same_as_cpp(parser, filepath, args, is_source=True):
+    report = compare_with_cpp(parser, filepath, args, CPP, is_source)
+    assert report["macro_mismatch_count"] == 0 and report["line_mismatch_count"] == 0, (
+        format_compare_report(report)
+    )
+    return report
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_generated_tree(tmp_path, seed):
+    source, args = TreeGenerator(seed).write_tree(str(tmp_path))
+    parser = Parser()
+    parser.add_include_path(args[1])
+    parser.read_folder_h(str(tmp_path))
+    parser.publish()
+    report = _assert_same_as_cpp(parser, source, args)
+    assert report["macros_compared"] > 10 and report["lines_compared"] > 10
+    # the parser keeps one table for the folder, so only the header including all others
+    # sees the same defines as the preprocessor
+    _assert_same_as_cpp(parser, os.path.join(args[1], "h2.h"), args, is_source=False)
+
+
+@pytest.mark.skipif(not REAL_TREES, reason="DEFINE_PARSER_CPP_TREES is not set")
+@pytest.mark.parametrize("tree", REAL_TREES)
+def test_real_tree(tree):
+    parser = Parser()
+    compile_flags = os.path.join(tree, "compile_flags.txt")
+    if os.path.isfile(compile_flags):
+        with open(compile_flags) as fs:
+            flags_txt = fs.read()
+        parser.load_compile_flags(flags_txt, tree)
+        args = flags_txt.split()
+    else:
+        args = []
+    parser.read_folder_h(tree)
+    parser.publish()
+    if not args:
+        for include_dir in sorted({os.path.dirname(header) for header in parser.header_files}):
+            args += ["-I", include_dir]
+    for source in glob_recursive(tree, [".c"]):
+        _assert_same_as_cpp(parser, source, args)
@@ -0,0 +1,41 @@
+import io
+import json
+import sqlite3
+
+from DefineParser.utils.export import DEFINE_FIELDS, export_jsonl, export_sqlite
+
+
+def _record(name, value, config=""):
+    record = dict.fromkeys(DEFINE_FIELDS)
+    record.update(name=name, body=str(value), expanded=str(value), value=value, config=config)
+    return record
+
+
+def _rows(db_path):
+    conn = sqlite3.connect(str(db_path))
+    try:
+        return sorted(conn.execute("SELECT name, value, config FROM defines"))
+    finally:
+        conn.close()
+
+
+def test_export_jsonl():
+    fileio = io.StringIO()
+    assert export_jsonl([_record("AA", 1), _record("BB", None)], fileio) == 2
+    lines = fileio.getvalue().splitlines()
+    assert [json.loads(line)["name"] for line in lines] == ["AA", "BB"]
+
+
+def test_export_sqlite_replaces_config(tmp_path):
+    db_path = tmp_path / "defines.db"
+    export_sqlite([_record("AA", 1, "debug"), _record("BB", 2**64, "debug")], str(db_path), "debug")
+    export_sqlite([_record("AA", 3, "release")], str(db_path), "release")
+    export_sqlite([_record("CC", 4, "debug")], str(db_path), "debug")
+    assert _rows(db_path) == [("AA", 3, "release"), ("CC", 4, "debug")]
+
+
+def test_export_sqlite_empty_records_clear_config(tmp_path):
+    db_path = tmp_path / "defines.db"
+    export_sqlite([_record("AA", 1, "debug")], str(db_path), "debug")
+    assert export_sqlite([], str(db_path), "debug") == 0
+    assert _rows(db_path) == []
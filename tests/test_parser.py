@@ -0,0 +1,199 @@
+import pickle
+
+from DefineParser.C_DefineParser import Define, Parser
+
+
+def _parser(**defines):
+    p = Parser()
+    for name, token in defines.items():
+        p.insert_define(name, token=token)
+    return p
+
+
+def test_scope_function_sees_scope_names():
+    p = _parser(BASE="2")
+    scope = p.scoped()
+    scope._insert_define(Define("LOC", None, "5"))
+    scope._insert_define(Define("FN", ["x"], "(x + LOC + BASE)"))
+    assert scope.cdef.try_eval_num("FN(1)") == 8
+    assert scope.cdef.try_eval_num(scope.expand_token("FN(1)")) == 8
+    assert p.cdef.try_eval_num("LOC") is None
+
+
+def test_scope_undef_hides_base_name():
+    p = _parser(BASE="2")
+    scope = p.scoped()
+    scope._do_define_directive("#undef BASE")
+    assert scope.cdef.try_eval_num("BASE") is None
+    assert p.cdef.try_eval_num("BASE") == 2
+
+
+def test_scope_sees_names_defined_in_base_later():
+    p = _parser()
+    scope = p.scoped()
+    assert scope.cdef.try_eval_num("LATE") is None
+    p.insert_define("LATE", token="7")
+    assert scope.cdef.try_eval_num("LATE") == 7
+
+
+def test_snapshot_not_modified_by_builder(tmp_path):
+    (tmp_path / "base.h").write_text("#define BASE 1\n")
+    (tmp_path / "conf.h").write_text('#include "base.h"\n#define CONF (BASE + 1)\n')
+    p = Parser()
+    p.read_folder_h(str(tmp_path))
+    snap = p.snapshot()
+    trees = {file_id: list(headers) for file_id, headers in snap.include_trees.items()}
+    for headers in p.include_trees.values():
+        headers.append(headers[0])
+    assert snap.include_trees == trees
+
+
+def test_read_c_leaves_parser_untouched(tmp_path):
+    (tmp_path / "conf.h").write_text("#define CONF 2\n")
+    src = tmp_path / "main.c"
+    src.write_text('#include "conf.h"\n#define LOCAL (CONF + 1)\nint x;\n')
+    p = Parser()
+    p.read_folder_h(str(tmp_path))
+    p.publish()
+    trees = dict(p.include_trees)
+    filelines = dict(p.filelines)
+    with p.read_c(str(src)) as scope:
+        assert scope.cdef.try_eval_num(scope.expand_token("LOCAL")) == 3
+        assert scope.include_trees[p.files.intern(str(src))]
+    assert dict(p.include_trees) == trees
+    assert p.filelines == filelines
+    assert "LOCAL" not in p.defs
+    assert list(p.get_directive_lines(str(src))) == [2]
+
+
+def test_build_value_table_reuses_unchanged_values(tmp_path):
+    header = tmp_path / "conf.h"
+    header.write_text("#define AA 1\n#define BB (AA + 1)\n#define CC 10\n#define DD (CC * 2)\n")
+    old = Parser()
+    old.read_folder_h(str(tmp_path))
+    old.publish().build_value_table()
+
+    header.write_text("#define AA 5\n#define BB (AA + 1)\n#define CC 10\n#define DD (CC * 2)\n#define EE DD\n")
+    new = Parser()
+    new.read_folder_h(str(tmp_path))
+    new.publish().build_value_table(old)
+    assert new.values == {"AA": 5, "BB": 6, "CC": 10, "DD": 20, "EE": 20}
+    assert new.stats.counters["values_reused"] == 2
+
+
+def test_pickle_round_trip(tmp_path):
+    (tmp_path / "conf.h").write_text("#define AA 1\n#define BB (AA + 1)\n#define FN(x) ((x) * BB)\n")
+    p = Parser()
+    p.read_folder_h(str(tmp_path))
+    p.publish().build_value_table()
+    p.cdef.try_eval_num("BB")  # compiles into the environment
+    data = pickle.dumps(p.pickable())
+    loaded = pickle.loads(data)
+    assert loaded.defs == p.defs
+    assert loaded.values == p.values
+    assert loaded.cdef.try_eval_num(loaded.expand_token("FN(3)")) == 6
+    scope = loaded.scoped()
+    scope._insert_define(Define("LOC", None, "BB"))
+    assert scope.cdef.try_eval_num(scope.expand_token("LOC")) == 2
+
+    assert p.cdef.try_eval_num("BB") == 2  # the published parser keeps its environment
+
+
+def test_overlay_keeps_temp_defines_off_shared_parser(tmp_path):
+    (tmp_path / "conf.h").write_text("#define AA 1\n#define BB (AA + 1)\n")
+    p = Parser()
+    p.read_folder_h(str(tmp_path))
+    p.publish().build_value_table()
+    src = str(tmp_path / "a.c")
+    view = p.overlay()
+    view.insert_temp_define("AA", token="5", filename=src)
+    assert view.is_defined("AA", src)
+    assert view.get_cached_value("BB", src) is None  # depends on the file's own AA
+    assert p.get_cached_value("BB", src) == 2
+    assert not p.temp_defs
+    pickle.dumps(p.pickable())
+
+
+def test_lookups_built_ahead_of_readers(tmp_path):
+    (tmp_path / "conf.h").write_text("#define AA 1\n#define BB (AA + 1)\n")
+    p = Parser()
+    p.read_folder_h(str(tmp_path))
+    assert not p.snapshot().has_lookups()
+    loaded = pickle.loads(pickle.dumps(p.publish().build_lookups().pickable()))
+    assert p.has_lookups()
+    assert not loaded.has_lookups()  # built again by the loading thread
+    assert loaded.build_lookups().has_lookups()
+    assert [define.name for define in loaded.find_defines("B")] == ["BB"]
+
+
+def test_else_inactive_after_taken_branch(tmp_path):
+    src = tmp_path / "main.c"
+    src.write_text("#if 1\nint aa;\n#elif 1\nint bb;\n#else\nint cc;\n#endif\n")
+    p = Parser()
+    p.publish()
+    assert p.active_lines(str(src)) & {2, 4, 6} == {2}
+
+
+def test_condition_defined_and_unknown_names():
+    p = _parser(AA="1")
+    assert p.eval_condition("!defined(BB)") == 1
+    assert p.eval_condition("defined AA && !defined(AA)") == 0
+    assert p.eval_condition("UNKNOWN || defined(AA)") == 1
+    assert p.eval_condition("!UNKNOWN") == 1
+
+
+def test_values_follow_undef_of_used_name():
+    p = _parser(AA="1", BB="(AA + 1)")
+    assert p.cdef.try_eval_num("BB") == 2
+    p._do_define_directive("#undef AA")
+    assert p.cdef.try_eval_num("BB") is None
+    p.insert_define("AA", token="5")
+    assert p.cdef.try_eval_num("BB") == 6
+    scope = p.scoped()
+    scope._insert_define(Define("AA", None, "7"))
+    assert scope.cdef.try_eval_num("BB") == 8
+    assert p.cdef.try_eval_num("BB") == 6
+
+
+def test_deep_define_chain_evaluates():
+    p = Parser()
+    p.insert_define("M0", token="1")
+    for i in range(1, 3000):
+        p.insert_define("M%d" % i, token="(M%d + 1)" % (i - 1))
+    assert p.cdef.try_eval_num("M2999") == 3000
+    assert p.expand_token("M2999") == "3000"
+
+
+def test_redefine_recompiles_only_users():
+    p = _parser(AA="1", BB="(AA + 1)", CC="(BB * 2)", DD="10")
+    assert p.cdef.try_eval_num("CC + DD") == 14
+    p.insert_define("AA", token="5")
+    namespace = p.cdef._globals
+    assert "DD" in namespace.compiled and "BB" in namespace.pending and "CC" in namespace.pending
+    assert p.cdef.try_eval_num("CC") == 12
+
+
+def test_undef_in_long_chain_keeps_guarded_defines(tmp_path):
+    lines = ["#define M0 1", "#define TMP 0"]
+    for i in range(1, 2000):
+        lines.append("#define M%d (M%d + 1)" % (i, i - 1))
+        if i % 50 == 0:
+            lines += ["#undef TMP", "#define TMP %d" % i]
+            lines += ["#if TMP >= 0 && M%d > 3" % i, "#define G%d 1" % i, "#endif"]
+    (tmp_path / "chain.h").write_text("\n".join(lines) + "\n")
+    p = Parser()
+    p.read_folder_h(str(tmp_path))
+    assert len(p.defs) == 2000 + 1 + 39
+
+
+def test_readers_keep_build_stats(tmp_path):
+    (tmp_path / "conf.h").write_text("#define AA 1\n#if AA\n#define BB 2\n#endif\n")
+    src = tmp_path / "main.c"
+    src.write_text('#include "conf.h"\n#if BB\nint x;\n#endif\n')
+    p = Parser()
+    p.read_folder_h(str(tmp_path))
+    p.publish()
+    assert p.stats.counters["is_active"] == 4
+    timings = dict(p.stats.timings)
+    assert 3 in p.active_lines(str(src))
+    assert p.stats.timings == timings and p.stats.counters["is_active"] == 4
@@ -0,0 +1,41 @@
+import threading
+
+from DefineParser.utils.stats import BuildStats, deep_sizeof
+
+
+def test_deep_sizeof_counts_shared_objects_once():
+    shared = ["x" * 1000]
+    seen = set()
+    first = deep_sizeof({"a": shared}, seen)
+    second = deep_sizeof({"b": shared}, seen)
+    assert first > 1000 > second
+
+
+def test_deep_sizeof_while_filling():
+    values = {}
+
+    def fill():
+        for i in range(200000):
+            values["NAME_%d" % i] = [i]
+
+    filler = threading.Thread(target=fill)
+    filler.start()
+    try:
+        while filler.is_alive():
+            deep_sizeof(values)
+    finally:
+        filler.join()
+
+
+def test_stats_counters():
+    stats = BuildStats()
+    stats.count("defines", 3)
+    stats.count("defines")
+    assert stats.counters["defines"] == 4
+
+
+def test_timed_iter_records_once():
+    stats = BuildStats()
+    assert list(stats.timed_iter("phase", range(3))) == [0, 1, 2]
+    assert stats.counters["phase"] == 1
+    assert stats.timings["phase"] >= 0
@@ -0,0 +1,40 @@
+from DefineParser.utils.txt_op import iter_directive_lines, remove_comment
+
+
+def _directives(text):
+    return [(line_no, line.strip()) for line_no, line in iter_directive_lines(text.encode())]
+
+
+def test_directive_lines():
+    text = "#define A 1\nint a;\n  #  if A\n#endif\n"
+    assert _directives(text) == [(1, "#define A 1"), (3, "#  if A"), (4, "#endif")]
+
+
+def test_directive_continuation():
+    text = "#define A \\\n  1\n#define B 2\n"
+    assert _directives(text) == [(1, "#define A \\"), (2, "1"), (3, "#define B 2")]
+
+
+def test_directive_in_comments_skipped():
+    text = "/*\n#define A 1\n*/\n// #define B 2\nint c; // x\n#define C 3\n"
+    assert _directives(text) == [(6, "#define C 3")]
+
+
+def test_directive_after_inline_comment():
+    text = "/* x */ #define D 4\n/* a */ /* b */ #define E 5\nint a; /* y */ #define F 6\n"
+    assert _directives(text) == [(1, "#define D 4"), (2, "#define E 5")]
+
+
+def test_directive_after_multiline_comment():
+    text = "/* multi\n line */ #define G 7\n"
+    assert _directives(text) == [(2, "#define G 7")]
+
+
+def test_directive_lines_match_remove_comment():
+    text = "/* x */ #define D 4\n#define E 5 /* y */\n/* z\n#define F 6 */\n#define G 7 // w\n"
+    expected = [
+        (line_no, line.strip())
+        for line_no, line in enumerate(remove_comment(text.splitlines()), 1)
+        if line.strip().startswith("#")
+    ]
+    assert _directives(text) == expected
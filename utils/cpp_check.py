@@ -0,0 +1,186 @@
+import os
+import re
+import subprocess
+import tempfile
+import time
+
+from .txt_op import remove_comment
+
+REGEX_CPP_DEFINE = re.compile(r"#define (?P<NAME>\w+)(?P<PARAMS>\([^)]*\))?")
+REGEX_LINEMARKER = re.compile(r'# (?P<LINE>\d+) "(?P<FILE>(?:[^"\\]|\\.)*)"')
+CHECK_MARKER = "__define_parser_check__"
+
+RUN_KWARGS = {}
+if os.name == "nt":
+    RUN_KWARGS["creationflags"] = subprocess.CREATE_NO_WINDOW
+
+
+def flags_to_args(defines, include_flags) -> list:
+    """compiler arguments of (name, value) defines and (flag, path) include options"""
+    args = ["-D%s=%s" % (name, value) for name, value in defines]
+    for flag, path in include_flags:
+        args += [flag, path]
+    return args
+
+
+def run_cpp(cpp, args) -> str:
+    """stdout of the preprocessor, raise subprocess.CalledProcessError with its stderr on failure"""
+    proc = subprocess.run(
+        [cpp] + list(args),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        errors="replace",
+        **RUN_KWARGS
+    )
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, proc.stdout, proc.stderr)
+    return proc.stdout
+
+
+def cpp_object_macros(cpp, args, filepath) -> list:
+    """names of the object-like macros defined after preprocessing `filepath`"""
+    output = run_cpp(cpp, args + ["-dM", "-E", filepath])
+    names = []
+    for line in output.splitlines():
+        match = REGEX_CPP_DEFINE.match(line)
+        if match is not None and match.group("PARAMS") is None:
+            names.append(match.group("NAME"))
+    return names
+
+
+def cpp_expand_macros(cpp, args, filepath, names) -> dict:
+    """dict[name, expansion by the preprocessor] of macros `names` at the end of `filepath`"""
+    fd, check_file = tempfile.mkstemp(suffix=os.path.splitext(filepath)[1] or ".c")
+    try:
+        with os.fdopen(fd, "w") as fs:
+            fs.write('#include "%s"\n' % os.path.abspath(filepath).replace("\\", "/"))
+            for name in names:
+                fs.write("%s %s\n" % (CHECK_MARKER, name))
+        output = run_cpp(cpp, args + ["-E", "-P", check_file])
+    finally:
+        os.remove(check_file)
+    expansions = [
+        line[len(CHECK_MARKER) :].strip()
+        for line in output.splitlines()
+        if line.startswith(CHECK_MARKER)
+    ]
+    return dict(zip(names, expansions))
+
+
+def cpp_active_lines(cpp, args, filepath) -> set:
+    """line numbers of `filepath` having code in the preprocessor output"""
+    output = run_cpp(cpp, args + ["-E", filepath])
+    target = os.path.normcase(os.path.realpath(filepath))
+    is_target = {}  # dict[file in linemarker, bool]
+    in_target = False
+    lineno = 0
+    active_lines = set()
+    for line in output.splitlines():
+        match = REGEX_LINEMARKER.match(line)
+        if match is not None:
+            marker_file = match.group("FILE")
+            if marker_file not in is_target:
+                path = marker_file.replace("\\\\", "\\")
+                is_target[marker_file] = os.path.normcase(os.path.realpath(path)) == target
+            in_target = is_target[marker_file]
+            lineno = int(match.group("LINE"))
+            continue
+        if in_target and line.strip():
+            active_lines.add(lineno)
+        lineno += 1
+    return active_lines
+
+
+def code_lines(filepath) -> set:
+    """line numbers of single-line code in `filepath`, not blank, comment, directive or continued"""
+    lines = set()
+    with open(filepath, "r", errors="replace") as fs:
+        continued = False
+        for lineno, line in enumerate(remove_comment(fs), 1):
+            text = line.strip()
+            was_continued, continued = continued, text.endswith("\\")
+            if text and not text.startswith("#") and not was_continued and not continued:
+                lines.add(lineno)
+    return lines
+
+
+def compare_with_cpp(parser, filepath, args, cpp="cpp", is_source=True, max_mismatches=100) -> dict:
+    """differences between `parser` and the C preprocessor on file `filepath`
+
+    Compares the values of object-like macros known to both, and the active state of the
+    code lines. `args`: extra preprocessor arguments, ie: from `flags_to_args()`.
+    """
+    start = time.perf_counter()
+    names = cpp_object_macros(cpp, args, filepath)
+    cpp_active = cpp_active_lines(cpp, args, filepath)
+    cpp_expansions = cpp_expand_macros(cpp, args, filepath, names)
+    cpp_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ctx_mgr = parser.read_c if is_source else parser.read_h
+    parser_active = parser.active_lines(filepath, is_source=is_source)
+    macro_results = []
+    with ctx_mgr(filepath, try_if_else=True) as scope:
+        for name in names:
+            define = scope.defs.get(name)
+            expansion = cpp_expansions.get(name, "")
+            # the parser takes an empty define as 1, like a flag given by -DNAME
+            if define is None or define.params is not None or not expansion:
+                continue
+            value = scope.cdef.try_eval_num(scope.expand_token(define.token))
+            macro_results.append((name, value, scope.cdef.try_eval_num(expansion)))
+    parser_seconds = time.perf_counter() - start
+
+    macro_mismatches = [
+        (name, value, cpp_value) for name, value, cpp_value in macro_results if value != cpp_value
+    ]
+    lines = sorted(code_lines(filepath))
+    line_mismatches = [
+        (lineno, lineno in parser_active, lineno in cpp_active)
+        for lineno in lines
+        if (lineno in parser_active) != (lineno in cpp_active)
+    ]
+    return {
+        "file": filepath,
+        "cpp_seconds": cpp_seconds,
+        "parser_seconds": parser_seconds,
+        "macros_compared": len(macro_results),
+        "macro_mismatches": macro_mismatches[:max_mismatches],
+        "macro_mismatch_count": len(macro_mismatches),
+        "lines_compared": len(lines),
+        "line_mismatches": line_mismatches[:max_mismatches],
+        "line_mismatch_count": len(line_mismatches),
+    }
+
+
+def format_compare_report(report) -> str:
+    lines = ["# Define Parser vs C preprocessor: %s" % report["file"], ""]
+    lines.append(
+        "time: parser %.3f s, preprocessor %.3f s (x%.2f)"
+        % (
+            report["parser_seconds"],
+            report["cpp_seconds"],
+            report["parser_seconds"] / max(report["cpp_seconds"], 1e-9),
+        )
+    )
+    lines.append(
+        "macros: %d compared, %d mismatched"
+        % (report["macros_compared"], report["macro_mismatch_count"])
+    )
+    lines.append(
+        "code lines: %d compared, %d mismatched"
+        % (report["lines_compared"], report["line_mismatch_count"])
+    )
+    if report["macro_mismatches"]:
+        lines += ["", "## Macro values (parser / preprocessor)", ""]
+        for name, value, cpp_value in report["macro_mismatches"]:
+            lines.append("%-40s %s / %s" % (name, value, cpp_value))
+    if report["line_mismatches"]:
+        lines += ["", "## Active lines (parser / preprocessor)", ""]
+        for lineno, active, cpp_active in report["line_mismatches"]:
+            lines.append(
+                "%6d  %s / %s"
+                % (lineno, "active" if active else "inactive", "active" if cpp_active else "inactive")
+            )
+    return "\n".join(lines) + "\n"
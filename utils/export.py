@@ -0,0 +1,65 @@
+import json
+
+# columns of an exported define record, in order
+DEFINE_FIELDS = ("name", "params", "body", "expanded", "value", "file", "lineno", "config")
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS defines (
+    name TEXT NOT NULL,
+    params TEXT,
+    body TEXT,
+    expanded TEXT,
+    value,
+    file TEXT,
+    lineno INTEGER,
+    config TEXT
+)
+"""
+SQLITE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS defines_name ON defines (name)",
+    "CREATE INDEX IF NOT EXISTS defines_file ON defines (file)",
+)
+SQLITE_INT_RANGE = range(-(2**63), 2**63)
+
+
+def export_jsonl(records, fileio) -> int:
+    """write each record dict as a line of JSON, return the number of records"""
+    count = 0
+    for record in records:
+        fileio.write(json.dumps(record))
+        fileio.write("\n")
+        count += 1
+    return count
+
+
+def export_sqlite(records, db_path, config="") -> int:
+    """insert the records of `config` into table `defines` of `db_path`, replacing its old ones
+
+    return the number of records.
+    """
+    import sqlite3
+
+    count = 0
+
+    def rows():
+        nonlocal count
+        for record in records:
+            value = record["value"]
+            if value is not None and value not in SQLITE_INT_RANGE:
+                record["value"] = str(value)  # out of range of SQLite INTEGER
+            count += 1
+            yield tuple(record[field] for field in DEFINE_FIELDS)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        with conn:
+            conn.execute(SQLITE_SCHEMA)
+            conn.execute("DELETE FROM defines WHERE config = ?", (config,))
+            conn.executemany(
+                "INSERT INTO defines VALUES (%s)" % ", ".join("?" * len(DEFINE_FIELDS)), rows()
+            )
+            for statement in SQLITE_INDEXES:
+                conn.execute(statement)
+    finally:
+        conn.close()
+    return count
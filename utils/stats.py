@@ -0,0 +1,160 @@
+import builtins
+import heapq
+import json
+import sys
+import time
+import types
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class BuildStats:
+    """accumulated timings and counters of the define database building"""
+
+    def __init__(self, top_n=20):
+        self.top_n = top_n
+        self.reset()
+
+    def reset(self):
+        self.timings = defaultdict(float)  # dict[phase: str, seconds: float]
+        self.counters = defaultdict(int)  # dict[name: str, count: int]
+        self._slowest_files = []  # min-heap of (seconds, filepath)
+        self.memory = {}  # dict[name: str, bytes: int], ie: peak of traced memory
+        self.memory_sites = []  # list of (bytes, source line) allocating the most memory
+
+    @contextmanager
+    def timeit(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def add_time(self, phase, seconds, calls=1):
+        self.timings[phase] += seconds
+        self.counters[phase] += calls
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def timed_iter(self, phase, iterable):
+        """yield from `iterable`, only the time spent inside the iterable is recorded"""
+        perf_counter = time.perf_counter
+        elapsed = 0.0
+        try:
+            start = perf_counter()
+            for item in iterable:
+                elapsed += perf_counter() - start
+                yield item
+                start = perf_counter()
+            elapsed += perf_counter() - start
+        finally:
+            self.add_time(phase, elapsed)
+
+    def record_memory(self, name, nbytes):
+        self.memory[name] = nbytes
+
+    def record_file(self, filepath, seconds):
+        entry = (seconds, filepath)
+        if len(self._slowest_files) < self.top_n:
+            heapq.heappush(self._slowest_files, entry)
+        elif entry > self._slowest_files[0]:
+            heapq.heapreplace(self._slowest_files, entry)
+
+    @property
+    def slowest_files(self) -> list:
+        return sorted(self._slowest_files, reverse=True)
+
+    def as_dict(self) -> dict:
+        return {
+            "timings": {
+                phase: {"seconds": round(sec, 6), "calls": self.counters[phase]}
+                for phase, sec in sorted(self.timings.items(), key=lambda x: -x[1])
+            },
+            "counters": {
+                name: cnt
+                for name, cnt in sorted(self.counters.items())
+                if name not in self.timings
+            },
+            "slowest_files": [
+                {"file": f, "seconds": round(sec, 6)} for sec, f in self.slowest_files
+            ],
+            "memory": dict(self.memory),
+            "memory_sites": [{"site": site, "bytes": size} for size, site in self.memory_sites],
+        }
+
+    def to_json(self, indent=2) -> str:
+        return json.dumps(self.as_dict(), indent=indent)
+
+    def format_report(self) -> str:
+        data = self.as_dict()
+        lines = ["# Timings", ""]
+        lines.append("%-32s %12s %10s" % ("phase", "seconds", "calls"))
+        for phase, t in data["timings"].items():
+            lines.append("%-32s %12.4f %10d" % (phase, t["seconds"], t["calls"]))
+        lines += ["", "# Counters", ""]
+        for name, cnt in data["counters"].items():
+            lines.append("%-32s %12d" % (name, cnt))
+        lines += ["", "# Slowest files (exclusive time)", ""]
+        for f in data["slowest_files"]:
+            lines.append("%10.4f  %s" % (f["seconds"], f["file"]))
+        if data["memory"]:
+            lines += ["", "# Traced memory", ""]
+            for name, nbytes in data["memory"].items():
+                lines.append("%-32s %12s" % (name, format_bytes(nbytes)))
+            for site in data["memory_sites"]:
+                lines.append("%12s  %s" % (format_bytes(site["bytes"]), site["site"]))
+        return "\n".join(lines) + "\n"
+
+
+def format_bytes(nbytes) -> str:
+    for unit in ("B", "KB", "MB"):
+        if abs(nbytes) < 1024:
+            return "%d %s" % (nbytes, unit)
+        nbytes /= 1024
+    return "%.1f GB" % nbytes
+
+
+# not owned by any object measured by `deep_sizeof()`
+_SHARED_TYPES = (type, types.ModuleType, types.FrameType, types.BuiltinFunctionType)
+
+
+def deep_sizeof(obj, seen=None) -> int:
+    """approximate bytes of `obj` and all objects reachable from it
+
+    Objects in `seen` (a set of IDs, updated here) are not counted again, share it between
+    calls to split memory among several components. Functions are counted without their
+    globals, modules and classes are not counted.
+    """
+    if seen is None:
+        seen = set()
+    seen.add(id(builtins.__dict__))
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, _SHARED_TYPES):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        # containers are copied before walking, other threads may be filling them
+        if isinstance(o, dict):
+            for item in list(o.items()):
+                stack.extend(item)
+            stack.append(getattr(o, "__dict__", None))  # of a dict subclass
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(list(o))
+        elif isinstance(o, (str, bytes, int, float, bool)) or o is None:
+            continue
+        elif isinstance(o, types.FunctionType):
+            stack.append(o.__code__)
+            stack.append(o.__defaults__)
+        elif isinstance(o, types.CodeType):
+            stack.extend((o.co_code, o.co_consts, o.co_names, o.co_varnames))
+        else:
+            stack.append(getattr(o, "__dict__", None))
+            for cls in type(o).__mro__:
+                slots = cls.__dict__.get("__slots__", ())
+                for slot in (slots,) if isinstance(slots, str) else slots:
+                    stack.append(getattr(o, slot, None))
+    return total
@@ -43,51 +43,100 @@ def remove_comment(texts: list, keep_line_comment=False):
             yield clean_txt
 
 
-REG_LITERALS = [
-    re.compile(r"\b(?P<NUM>[0-9]+)(?:##)?([ul]|ull?|ll?u|ll)\b", re.IGNORECASE),
-    re.compile(r"\b(?P<NUM>0b[01]+)(?:##)?([ul]|ull?|ll?u|ll)\b", re.IGNORECASE),
-    re.compile(r"\b(?P<NUM>0[0-7]+)(?:##)?([ul]|ull?|ll?u|ll)\b", re.IGNORECASE),
-    re.compile(r"\b(?P<NUM>0x[0-9a-f]+)(?:##)?([ul]|ull?|ll?u|ll)\b", re.IGNORECASE),
-]
-REG_SPECIAL_SIZEOFTYPES = [
-    re.compile(r"sizeof\(\s*U8\s*\)"),
-    re.compile(r"sizeof\(\s*U16\s*\)"),
-    re.compile(r"sizeof\(\s*U32\s*\)"),
-    re.compile(r"sizeof\(\s*U64\s*\)"),
-]
-REG_SPECIAL_TYPES = [
-    re.compile(r"\(\s*U8\s*\)"),
-    re.compile(r"\(\s*U16\s*\)"),
-    re.compile(r"\(\s*U32\s*\)"),
-    re.compile(r"\(\s*U64\s*\)"),
-]
-REGEX_OPERATOR_NOT = re.compile(r"!([^=])")
-REGEX_CHAR = re.compile(r"'([ -~])'")
-
-def convert_op_c2py(txt: str) -> str:
-    # remove integer literals type hint
-    for re_reg in REG_LITERALS:
-        txt = re_reg.sub(r"\1", txt)
-    # calculate size of special type
-    # transform type cascading to bit mask for equivalence calculation
-    for data_sz, reg_sizeof_type, reg_special_type in zip(
-        [1, 2, 4, 8], REG_SPECIAL_SIZEOFTYPES, REG_SPECIAL_TYPES
-    ):
+REGEX_DIRECTIVE_SCAN = re.compile(rb"^[ \t]*#|/\*|\*/|//", re.MULTILINE)
+REGEX_AFTER_COMMENT = re.compile(rb"[ \t]*(?:#|/\*)")
+
+
+def iter_directive_lines(buf, encoding="utf-8"):
+    """yield (line_no, text) of directive lines and their continuations in bytes-like `buf`
+
+    lines inside block comments are skipped, and only yielded lines are decoded.
+    """
+    size = len(buf)
+    pos = 0
+    line_no = 1
+    counted_pos = 0
+    directive_end = 0
+    in_comment = False
+    comment_leads = False  # only blanks and comments before the open comment on its line
+    while True:
+        m = None
+        if in_comment:
+            comment_end = buf.find(b"*/", pos)
+            if comment_end < 0:
+                return
+            pos = comment_end + 2
+            in_comment = False
+            if comment_leads:
+                # directive after leading comments, ie: `/* x */ #define D 4`
+                m = REGEX_AFTER_COMMENT.match(buf, pos)
+        after_comment = m is not None
+        if m is None:
+            m = REGEX_DIRECTIVE_SCAN.search(buf, pos)
+            if m is None:
+                return
+        mark = m.group()
+        pos = m.end()
+        if mark.endswith(b"/*"):
+            in_comment = True
+            line_start = buf.rfind(b"\n", 0, m.start()) + 1
+            comment_leads = after_comment or not buf[line_start : m.start()].strip()
+        elif mark == b"//":
+            eol = buf.find(b"\n", pos)
+            pos = size if eol < 0 else eol
+        elif mark.endswith(b"#") and m.start() >= directive_end:
+            # keep scanning from `pos` inside the directive, for comment marks
+            start = m.start()
+            line_no += buf[counted_pos:start].count(b"\n")
+            counted_pos = start
+            raw_lines = []
+            directive_end = start
+            while directive_end < size:
+                eol = buf.find(b"\n", directive_end)
+                eol = size if eol < 0 else eol
+                raw_lines.append(buf[directive_end:eol])
+                directive_end = eol + 1
+                if not raw_lines[-1].rstrip().endswith(b"\\"):
+                    break
+            texts = (raw.decode(encoding, "replace") for raw in raw_lines)
+            for offset, text in enumerate(remove_comment(texts)):
+                yield (line_no + offset, text)
+
+
+REGEX_C2PY = re.compile(
+    r"'(?P<CHAR>[ -~])'"
+    # integer literals with type hint
+    r"|(?i:\b(?P<NUM>0x[0-9a-f]+|0b[01]+|[0-9]+)(?:##)?(?:ull?|ll?u|ll|[ul])\b)"
+    r"|sizeof\(\s*U(?P<SIZEOF>8|16|32|64)\s*\)"
+    r"|\(\s*U(?P<CAST>8|16|32|64)\s*\)"
+    r"|(?P<OP>&&|\|\||!(?!=)|/)"
+)
+C2PY_OPERATORS = {"&&": " and ", "||": " or ", "!": " not ", "/": "//"}
+
+
+def _c2py_replace(match) -> str:
+    kind = match.lastgroup
+    if kind == "OP":
+        return C2PY_OPERATORS[match.group("OP")]
+    if kind == "NUM":
+        # remove integer literals type hint
+        return match.group("NUM")
+    if kind == "SIZEOF":
+        # sizeof(U16) -> 2
+        return str(int(match.group("SIZEOF")) // 8)
+    if kind == "CAST":
+        # transform type cascading to bit mask for equivalence calculation
         # limitation:
         #   for equation like (U32)1 << (U32)(15) may be calculated to wrong value
         #   due to operator order
-        # sizeof(U16) -> 2
-        txt = reg_sizeof_type.sub(str(data_sz), txt)
         # (U16)x -> 0xFFFF & x
-        txt = reg_special_type.sub("0x%s & " % ("F" * data_sz * 2), txt)
-    # syntax translation from C -> Python
-    txt = txt.replace("/", "//")
-    txt = txt.replace("&&", " and ")
-    txt = txt.replace("||", " or ")
-    txt = REGEX_OPERATOR_NOT.sub(r" not \1", txt)
-    for char in REGEX_CHAR.finditer(txt):
-        txt = txt.replace(char.group(), str(ord(char[1])))
-    return txt
+        return "0x%s & " % ("F" * (int(match.group("CAST")) // 4))
+    return str(ord(match.group("CHAR")))
+
+
+def convert_op_c2py(txt: str) -> str:
+    """syntax translation from C -> Python, in one pass over the expression"""
+    return REGEX_C2PY.sub(_c2py_replace, txt)
 
 
 def get_token_param_str(params) -> str: